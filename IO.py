@@ -1,11 +1,71 @@
-from itertools import permutations
+import sys, glob, gzip, bz2, lzma
+import numpy as np
+
+from parallel import pool_context, ordered_imap
 
 '''
 	Script with functions and classes for reading and writing treebank files
 '''
 
+# CoNLL-06 columns in file order, with their index in Sentence.columns
+COLUMNS = ['id', 'form', 'lemma', 'pos', 'xpos', 'morph', 'head', 'deprel', 'x', 'y']
+ID, FORM, LEMMA, POS, XPOS, MORPH, HEAD, DEPREL, X, Y = range(len(COLUMNS))
+STRING_COLUMNS = [FORM, LEMMA, POS, XPOS, MORPH, DEPREL, X, Y]		# Stored as Vocabulary ids; ID and HEAD are stored as ints
+
+class VocabularyIds(dict):		# string -> id; unseen strings are added on lookup
+
+	def __init__(self, strings):
+		super().__init__()
+		self.strings = strings
+
+	def __missing__(self, string):
+		vocab_id = len(self.strings)
+		self[string] = vocab_id
+		self.strings.append(string)
+		return vocab_id
+
+class Vocabulary:
+
+	'''
+		Interns column strings as int ids.
+		One Vocabulary (IO.vocabulary) is shared by every Sentence in the process,
+		so the same form or POS has the same id across the whole corpus.
+	'''
+
+	def __init__(self):
+		self.strings = []		# id -> string
+		self.ids = VocabularyIds(self.strings)		# string -> id
+
+	def __len__(self):
+		return len(self.strings)
+
+	def __getitem__(self, vocab_id):
+		return self.strings[vocab_id]
+
+	def index(self, string):
+		'''
+			Returns the id of string, adding it when unseen.
+		'''
+		return self.ids[string]
+
+	def encode(self, strings):
+		return list(map(self.ids.__getitem__, strings))		# map keeps the loop in C for known strings
+
+	def truncate(self, size):
+		'''
+			Forgets the strings added since the vocabulary held size strings, ie. those of sentences a long-running
+			process has finished with; ids of sentences encoded since then are no longer valid.
+		'''
+		for string in self.strings[size:]:
+			del self.ids[string]
+		del self.strings[size:]
+
+vocabulary = Vocabulary()
+
 class Token:
-	
+
+	__slots__ = COLUMNS
+
 	def __init__(self):		# Read all elements of tokens in data
 		self.id = None
 		self.form = None
@@ -18,148 +78,352 @@ class Token:
 		self.x = None
 		self.y = None
 
-class Sentence:		# Add all tokens as a list
-	
-	def __init__(self, token_items):        
-		# create ROOT token
-		root = Token()
-		root.id = '0'
-		root.form = 'ROOT'
-		root.lemma = '_'
-		root.pos = 'ROOT'
-		root.xpos = '_'
-		root.morph = '_'
-		root.head = '_'
-		root.deprel = '_'
-		root.x = '_'
-		root.y = '_'
-		
-		# initialize tokens with ROOT
-		self.tokens = [root]
-		
-		# add each token in token_items to sentence
-		for token in token_items:
-			self.tokens.append(token)
-				
+	def __setstate__(self, state):		# Also restores Tokens pickled before __slots__, whose state is a plain dict
+		if isinstance(state, tuple):
+			state = state[1]
+		for name, value in state.items():
+			setattr(self, name, value)
+
+# ROOT token fields; ROOT has no head
+ROOT_ROW = ['0', 'ROOT', '_', 'ROOT', '_', '_', '_', '_', '_', '_']
+
+def encode_fields(fields, vocab=vocabulary):
+	'''
+		Encodes a flat list of token fields, 10 per token, as an (n, 10) int32 array.
+		Works a column at a time on strided slices, so there is no Python loop per token.
+	'''
+	width = len(COLUMNS)
+	if len(fields) % width != 0:
+		raise ValueError("Every token line needs " + str(width) + " tab-separated columns")
+	columns = np.empty([len(fields) // width, width], dtype=np.int32)
+	for column in STRING_COLUMNS:
+		columns[:, column] = vocab.encode(fields[column::width])
+	columns[:, ID] = list(map(int, fields[ID::width]))
+	columns[:, HEAD] = [-1 if head == '_' else int(head) for head in fields[HEAD::width]]
+	return columns
+
+def encode_rows(rows, vocab=vocabulary):
+	'''
+		Encodes lists of the 10 column strings as an (n, 10) int32 array.
+	'''
+	if any(len(row) != len(COLUMNS) for row in rows):
+		raise ValueError("Every token line needs " + str(len(COLUMNS)) + " tab-separated columns")
+	return encode_fields([field for row in rows for field in row], vocab)
+
+class Sentence:		# Columnar sentence; one row of ints per token
+
+	'''
+		.columns -> (n, 10) int32 array with one row per token, ROOT first
+			ID and HEAD hold the ints themselves (-1 for a '_' head), every other column a Vocabulary id
+		.predicted -> int32 array of predicted heads, filled by the Model (-1 until then)
+	'''
+
+	def __init__(self, token_items):
+		# ROOT row first, then each token in token_items
+		rows = [ROOT_ROW] + [[getattr(token, column) for column in COLUMNS] for token in token_items]
+		self.columns = encode_rows(rows)
+		self.predicted = -np.ones(len(rows), dtype=np.int32)
+
+	@classmethod
+	def from_rows(cls, rows):
+		'''
+			Builds a sentence straight from lists of the 10 column strings, without Token objects.
+		'''
+		return cls.from_columns(encode_rows([ROOT_ROW] + rows))
+
+	@classmethod
+	def from_columns(cls, columns):
+		'''
+			Builds a sentence from an already encoded (n, 10) array; ROOT must be the first row.
+		'''
+		sentence = cls.__new__(cls)
+		sentence.columns = columns
+		sentence.predicted = -np.ones(len(columns), dtype=np.int32)
+		return sentence
+
+	def __len__(self):		# Number of tokens including ROOT
+		return len(self.columns)
+
+	@property
+	def ids(self):
+		return self.columns[:, ID]
+
+	@property
+	def forms(self):
+		return self.columns[:, FORM]
+
+	@property
+	def tags(self):
+		return self.columns[:, POS]
+
+	@property
+	def heads(self):		# Gold heads; writable view into self.columns
+		return self.columns[:, HEAD]
+
+	def strings(self, column):
+		'''
+			Returns one column as a list of strings, ie. sentence.strings(POS).
+		'''
+		if column == ID or column == HEAD:
+			return ['_' if value == -1 else str(value) for value in self.columns[:, column]]
+		return [vocabulary.strings[vocab_id] for vocab_id in self.columns[:, column]]
+
+	@property
+	def tokens(self):
+		'''
+			Token view of the sentence; built on demand, changes are not written back.
+		'''
+		tokens = [Token() for _ in range(len(self))]
+		for column, name in enumerate(COLUMNS):
+			for token, value in zip(tokens, self.strings(column)):
+				setattr(token, name, value)
+		return tokens
+
+	def use_predictions(self):
+		'''
+			Moves the predicted heads into the head column and blanks the x column, as written to .pred files.
+			The deprel column is blanked too: no labels are predicted, and the input's labels would score as predicted ones.
+		'''
+		self.heads[:] = self.predicted
+		self.columns[:, DEPREL] = vocabulary.index('_')
+		self.columns[:, X] = vocabulary.index('_')
+
+	def __getstate__(self):
+		'''
+			Pickle the strings instead of Vocabulary ids, which only hold within one process.
+		'''
+		state = dict(self.__dict__)
+		columns = self.columns.copy()
+		codes, inverse = np.unique(columns[:, STRING_COLUMNS], return_inverse=True)
+		columns[:, STRING_COLUMNS] = inverse.reshape(len(columns), len(STRING_COLUMNS))
+		state['columns'] = columns
+		state['strings'] = [vocabulary.strings[code] for code in codes]
+		return state
+
+	def __setstate__(self, state):
+		if 'tokens' in state:		# Sentence pickled before the columnar layout; its last column still ends with a newline
+			self.columns = encode_rows([[getattr(token, column).rstrip('\n') for column in COLUMNS] for token in state['tokens']])
+			self.predicted = -np.ones(len(self.columns), dtype=np.int32)
+			return
+		strings = state.pop('strings')
+		columns = state['columns']
+		codes = np.array(vocabulary.encode(strings), dtype=np.int32)
+		columns[:, STRING_COLUMNS] = codes[columns[:, STRING_COLUMNS]]
+		self.__dict__.update(state)
+
 	def potential_arcs(self):
 		'''
 			Helper function to get all potential arcs of the sentence.
+			Returns (head, dependant) int tuples in sorted order.
 		'''
-		# All possible permutations of tokens except for ROOT
-		arc_list = [(arc[0].id, arc[1].id) for arc in list(permutations(self.tokens[1:], 2))]
-		for token in self.tokens[1:]:
-			arc_list.append((self.tokens[0].id, token.id))		# Add ROOT arcs separately; only right-arc possible
-		return set(arc_list)		# May be unnecessary, but no duplicate arcs
-		
+		n = len(self)
+		# ROOT arcs and all pairs of tokens except for ROOT; ROOT is never a dependant
+		return [(head, dep) for head in range(n) for dep in range(1, n) if head != dep]
+
 	def gold_arcs(self):
 		'''
-			Helper function to get the gold arcs of the sentence directly from Token items.
+			Helper function to get the gold arcs of the sentence as a dictionary.
 		'''
-		arc_list = {}		# Dictionary of arcs; dependants are unique and therefore used as keys
-		for token in self.tokens[1:]:
-			head = token.head; dep = token.id
-			arc_list[dep] = head
-		return arc_list
+		# Dependants are unique and therefore used as keys
+		return {dep: int(head) for dep, head in enumerate(self.heads) if dep != 0}
 
 class Data:		# Helpful class to gather all sentences of a file
 
 	def __init__(self, sentences):
 		self.sentences = sentences
 
-	def evaluate(self):		# UAS function; named evaluate for possible expansion with LAS
-		correct, total, sentence_count = 0, 0, 0		# Init counts to 0
-		for sentence in self.sentences:
-			for token in sentence.tokens:
-				total += 1
-				if token.id == '0':		# Skip root as a dependant
-					continue
-				else:
-					predicted_head = token.x		# Store predicted head in one of the empty columns
-					gold_head = token.head		# Get gold head of current token
-					if predicted_head == gold_head:		# If correct, update count
-						correct += 1
-			sentence_count += 1
-		uas = correct/total		# Simple UAS with print statement
-		print("UAS score on", total, "tokens over", sentence_count, "sentences:", uas)
+	def evaluate(self, verbose=True, sample=None, rng=None):		# UAS; see evaluation.Evaluation for LAS and breakdowns
+		'''
+			UAS of sentence.predicted over every token except ROOT with a known gold head, in one pass over the corpus.
+			With sample, only that many sentences drawn with rng (a random.Random) are scored, ie. to keep per-epoch reports cheap.
+			None when no token has a known gold head, as in Evaluation.uas.
+		'''
+		sentences = self.sentences
+		if sample is not None and sample < len(sentences):
+			sentences = rng.sample(sentences, sample)
+		gold = np.concatenate([sentence.heads[1:] for sentence in sentences])		# Skip root as a dependant
+		predicted = np.concatenate([sentence.predicted[1:] for sentence in sentences])
+		known = gold >= 0		# '_' gold heads are not scored
+		total = int(np.count_nonzero(known))
+		uas = np.count_nonzero(predicted[known] == gold[known]) / total if total else None		# None without a known gold head
+		if verbose:
+			print("UAS score on", total, "tokens over", len(sentences), "sentences:", uas)
 		return uas
 
+# Openers for compressed treebanks, by file extension
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def open_treebank(filepath, mode='rt'):
+	'''
+		Opens a plain, .gz, .bz2 or .xz treebank file as UTF-8 text.
+		'-' is stdin for reading and stdout for writing; closing it leaves the standard stream open.
+	'''
+	if filepath == '-':
+		stream = sys.stdin if 'r' in mode else sys.stdout
+		return open(stream.fileno(), mode, encoding='utf-8', closefd=False)
+	for extension, opener in OPENERS.items():
+		if filepath.endswith(extension):
+			return opener(filepath, mode, encoding='utf-8')
+	return open(filepath, mode, encoding='utf-8')
+
+def encode_block(text, vocab=vocabulary):
+	'''
+		Encodes a block of whole sentences separated by blank lines.
+		Returns the (n, 10) rows of every sentence, each starting with a ROOT row, and the sentence lengths.
+	'''
+	chunks = [chunk.strip('\n') for chunk in text.split('\n\n')]
+	chunks = [chunk for chunk in chunks if chunk]		# Skips extra blank lines
+	lengths = np.array([chunk.count('\n') + 1 for chunk in chunks], dtype=np.int64)
+	# All token fields of the block as one flat list
+	fields = '\t'.join(chunks).replace('\n', '\t').split('\t') if chunks else []
+	if len(fields) != lengths.sum() * len(COLUMNS):
+		raise ValueError("Every token line needs " + str(len(COLUMNS)) + " tab-separated columns")
+	columns = encode_fields(fields, vocab)
+	starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+	columns = np.insert(columns, starts, encode_rows([ROOT_ROW], vocab)[0], axis=0)		# ROOT row before each sentence
+	return columns, lengths + 1
+
+def sentences_from_block(columns, lengths):
+	'''
+		Cuts the encoded rows of a block back into Sentences.
+	'''
+	offsets = np.concatenate([[0], np.cumsum(lengths)])
+	return [Sentence.from_columns(columns[offsets[i]:offsets[i+1]]) for i in range(len(lengths))]
+
+def parse_block(text):
+	'''
+		Parses a block of whole sentences into a list of Sentences.
+	'''
+	return sentences_from_block(*encode_block(text))
+
+def encode_block_worker(text):
+	'''
+		Worker side of parallel reading; encodes a block against its own Vocabulary
+		and returns (strings, columns, lengths), which are cheap to send back.
+	'''
+	vocab = Vocabulary()
+	columns, lengths = encode_block(text, vocab)
+	return vocab.strings, columns, lengths
+
 class Reader:
 
 	'''
 		Use the Reader object to read files as lists of Sentence objects.
+		filepath may be a single path, a glob pattern or a list of either; .gz, .bz2 and .xz files are decompressed.
+		Files are read in blocks of block_size characters; with processes > 1 blocks are parsed in worker processes.
 	'''
-	
-	def __init__(self, filepath):
+
+	def __init__(self, filepath, processes=1, block_size=1 << 24):
 		self.filepath = filepath	# Given the source filepath of the file
-	
-	def read_file(self):		# Read file with given filepath
-		f = open(self.filepath)
-		sentences = []		# Init list of sentences
-	
-		# Init token_items; information for each token
-		token_items = []
-	
-		for line in f:
-			# Init current sentence and token
-			token = Token()
-		
-			# If not at end of sentence
-			if line != '\n':
-				items = line.split('\t')
-			
-				# Add token data
-				token.id = items[0]
-				token.form = items[1]
-				token.lemma = items[2]
-				token.pos = items[3]
-				token.xpos = items[4]
-				token.morph = items[5]
-				token.head = items[6]
-				token.deprel = items[7]
-				token.x = items[8]
-				token.y = items[9]
-			
-				# Add Token to Sentence
-				token_items.append(token)
-		
-			# Add sentence and reset token_items
+		self.processes = processes
+		self.block_size = block_size
+
+	def filepaths(self):
+		'''
+			Expands self.filepath into the list of files to read, in order.
+		'''
+		patterns = [self.filepath] if isinstance(self.filepath, str) else list(self.filepath)
+		filepaths = []
+		for pattern in patterns:
+			if glob.has_magic(pattern):
+				matches = sorted(glob.glob(pattern))
+				if not matches:
+					raise FileNotFoundError("No files match " + pattern)
+				filepaths.extend(matches)
 			else:
-				sentences.append(Sentence(token_items))
-				token_items = []
-				
-		f.close()		# Just to be safe
+				filepaths.append(pattern)
+		return filepaths
+
+	def read_blocks(self):
+		'''
+			Yields blocks of text that each end on a sentence boundary.
+			The last sentence of a file is kept even without a trailing blank line.
+		'''
+		for filepath in self.filepaths():
+			with open_treebank(filepath) as f:
+				remainder = ''
+				while True:
+					text = f.read(self.block_size)
+					if not text:
+						break
+					text = remainder + text
+					cut = text.rfind('\n\n')		# Last sentence boundary in the block
+					if cut == -1:
+						remainder = text
+						continue
+					yield text[:cut]
+					remainder = text[cut+2:]
+				if remainder.strip():
+					yield remainder
+
+	def sentences(self):
+		'''
+			Yields Sentences one at a time as their lines arrive, for streaming.
+			Reads line by line, so a sentence is available as soon as its blank line is read, even from a pipe.
+		'''
+		for filepath in self.filepaths():
+			with open_treebank(filepath) as f:
+				rows = []
+				for line in f:
+					if line != '\n':
+						rows.append(line.rstrip('\n').split('\t'))
+					elif rows:
+						yield Sentence.from_rows(rows)
+						rows = []
+				if rows:		# No trailing blank line
+					yield Sentence.from_rows(rows)
+
+	def read_file(self):		# Read every file of self.filepath
+		sentences = []		# Init list of sentences
+		if self.processes > 1:
+			with pool_context().Pool(self.processes) as pool:
+				# Blocks come back in file order, with only a few read ahead of the one being decoded
+				for block, (strings, columns, lengths) in ordered_imap(pool, encode_block_worker, self.read_blocks(), 2 * self.processes):
+					codes = np.array(vocabulary.encode(strings), dtype=np.int32)		# Block ids -> ids of this process
+					columns[:, STRING_COLUMNS] = codes[columns[:, STRING_COLUMNS]]
+					sentences.extend(sentences_from_block(columns, lengths))
+		else:
+			for block in self.read_blocks():
+				sentences.extend(parse_block(block))
 		return sentences
 
 class Writer:
 
 	'''
 		Use the Writer object to write a list of sentences back into .CONLL06 format
+		sentences may be any iterable, ie. a generator; each sentence is written as soon as it is produced.
 	'''
-	
+
 	def __init__(self, filepath, sentences):		# filepath here is the target for writing the file
 		self.filepath = filepath
 		self.sentences = sentences
-		
-	def write_file(self):
+
+	def target_filepath(self):
+		'''
+			Default output file: <basename>.pred in the current directory.
+		'''
 		target_filename = self.filepath.split('/')[-1].rsplit('.', 1)[0]		# Remove potential tag ie. [.blind, .gold]
-		with open(target_filename+'.pred', 'w') as f:		# Add .pred tag
+		return target_filename+'.pred'		# Add .pred tag
+
+	def write_file(self, output_filepath=None, flush=False):
+		'''
+			Writes to output_filepath ('-' for stdout; compressed by extension) or to target_filepath().
+			With flush, the stream is flushed after every sentence so readers see it right away.
+		'''
+		if output_filepath is None:
+			output_filepath = self.target_filepath()
+		with open_treebank(output_filepath, 'wt') as f:
 			for sentence in self.sentences:
-				for token in sentence.tokens:
-					if token.form == 'ROOT':		# Don't write the ROOT token
-						continue
-					else:		# Include every other token with all information
-						line = ""
-						line+=token.id+'\t'
-						line+=token.form+'\t'
-						line+=token.lemma+'\t'
-						line+=token.pos+'\t'
-						line+=token.xpos+'\t'
-						line+=token.morph+'\t'
-						line+=token.head+'\t'
-						line+=token.deprel+'\t'
-						line+=token.x+'\t'
-						line+=token.y
-					
-						f.write(str(line))		# Write token line
-				f.write('\n')		# Newline
-			f.close()		# Insurance
+				self.write_sentence(f, sentence)
+				if flush:
+					f.flush()
+
+	@staticmethod
+	def write_sentence(f, sentence):
+		columns = [sentence.strings(column) for column in range(len(COLUMNS))]
+		lines = []
+		for i in range(1, len(sentence)):		# Don't write the ROOT token
+			# Include every other token with all information
+			lines.append('\t'.join([values[i] for values in columns]) + '\n')		# Token line
+		lines.append('\n')		# Newline
+		f.write(''.join(lines))
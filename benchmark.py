@@ -0,0 +1,204 @@
+import argparse, contextlib, io, json, os, platform, random, resource, subprocess, sys, tempfile, timeit, tracemalloc
+import numpy as np
+
+from IO import Reader, Data
+from feature import FeatureMapping, FeatureIndex
+from model import Model
+from decoders import DECODERS
+
+'''
+	Benchmarks every stage of the parser on a synthetic CoNLL-06 corpus and writes the results as JSON.
+	The corpus is generated from a seed, so two runs with the same arguments time the same work,
+	ie. before and after a commit; --baseline compares against an earlier results file.
+
+	python benchmark.py --sentences 2000 --lengths normal:25:10 --output results.json
+	python benchmark.py --sentences 2000 --lengths normal:25:10 --baseline results.json
+'''
+
+TAGS = ['NN', 'NNS', 'NNP', 'VB', 'VBD', 'VBZ', 'DT', 'JJ', 'IN', 'RB', 'PRP', 'CC', 'CD', 'TO', 'MD', 'POS']
+
+def sentence_lengths(spec, count, rng):
+	'''
+		count sentence lengths from a distribution spec:
+			fixed:N -> every sentence N tokens
+			uniform:MIN:MAX -> uniform between MIN and MAX
+			normal:MEAN:SD -> rounded normal, at least 1
+			lognormal:MEAN:SIGMA -> rounded lognormal with the given mean, at least 1; a long tail like real text
+	'''
+	name, *values = spec.split(":")
+	values = [float(value) for value in values]
+	if name == "fixed":
+		lengths = np.full(count, values[0])
+	elif name == "uniform":
+		lengths = rng.integers(int(values[0]), int(values[1]) + 1, count)
+	elif name == "normal":
+		lengths = rng.normal(values[0], values[1], count)
+	elif name == "lognormal":
+		lengths = rng.lognormal(np.log(values[0]) - values[1]**2 / 2, values[1], count)
+	else:
+		raise ValueError("Unknown length distribution " + repr(spec))
+	return np.maximum(np.rint(lengths), 1).astype(int)
+
+def generate_corpus(filepath, sentences, lengths, seed=0, vocabulary_size=5000):
+	'''
+		Writes a synthetic corpus: Zipf-distributed forms, a POS per form and random projective trees.
+		Returns the number of tokens written.
+	'''
+	rng = np.random.default_rng(seed)
+	heads_rng = random.Random(seed)
+	ranks = np.arange(1, vocabulary_size + 1)
+	probabilities = (1 / ranks) / (1 / ranks).sum()
+	tokens = 0
+	with open(filepath, 'w', encoding='utf-8') as f:
+		for n in sentence_lengths(lengths, sentences, rng):
+			forms = rng.choice(vocabulary_size, n, p=probabilities)
+			root = heads_rng.randint(1, n)
+			for i in range(1, n + 1):
+				if i == root:
+					head = 0
+				elif i < root:
+					head = heads_rng.randint(i + 1, root)
+				else:
+					head = heads_rng.randint(root, i - 1)
+				form = "w" + str(forms[i-1])
+				tag = TAGS[forms[i-1] % len(TAGS)]
+				f.write("\t".join([str(i), form, form, tag, tag, "_", str(head), "ROOT" if head == 0 else "dep", "_", "_"]) + "\n")
+			f.write("\n")
+			tokens += int(n)
+	return tokens
+
+class Benchmark:
+
+	'''
+		Times stages and records their throughput and memory.
+		max_rss_mb is the process's peak resident memory so far, so it only grows from stage to stage.
+		With trace_memory, peak_memory_mb is the tracemalloc peak of the stage alone (Python and NumPy allocations);
+		tracing slows pure-Python stages down many times over, so their times are then not comparable.
+	'''
+
+	def __init__(self, trace_memory=False):
+		self.trace_memory = trace_memory
+		self.stages = []
+
+	def run(self, stage, tokens, function, *args):
+		'''
+			Runs function(*args) as stage, with its prints silenced, and returns its result.
+		'''
+		if self.trace_memory:
+			tracemalloc.start()
+		starttime = timeit.default_timer()
+		with contextlib.redirect_stdout(io.StringIO()):
+			result = function(*args)
+		seconds = timeit.default_timer() - starttime
+		peak = None
+		if self.trace_memory:
+			peak = tracemalloc.get_traced_memory()[1] / 2**20
+			tracemalloc.stop()
+		self.stages.append({
+			"stage": stage,
+			"seconds": seconds,
+			"tokens": tokens,
+			"tokens_per_second": tokens / seconds if seconds > 0 else None,
+			"peak_memory_mb": peak,
+			"max_rss_mb": max_rss(),
+		})
+		print(stage.ljust(24), "%9.3f s" % seconds, "%12.0f tokens/s" % (tokens / max(seconds, 1e-9)), "%9.1f MB" % (max_rss() if peak is None else peak), file=sys.stderr)
+		return result
+
+def max_rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024		# Kilobytes on Linux
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_benchmark(args):
+	'''
+		Generates the corpus and times each stage on it; returns the results dictionary.
+	'''
+	benchmark = Benchmark(args.tracemalloc)
+	with tempfile.TemporaryDirectory() as directory:
+		filepath = os.path.join(directory, "benchmark.conll06")
+		tokens = generate_corpus(filepath, args.sentences, args.lengths, args.seed)
+		sentences = benchmark.run("read_file", tokens, Reader(filepath).read_file)
+	data = Data(sentences)
+	arc_count = sum((len(sentence) - 1)**2 for sentence in sentences)		# Arcs scored per pass, ROOT arcs included
+
+	feature_mapping = FeatureMapping(sentences, args.hash_bits)
+	benchmark.run("create_map", tokens, feature_mapping.create_map)
+	feature_mapping.frozen = True
+	feature_index = benchmark.run("extract_features", tokens, FeatureIndex.build, feature_mapping, sentences)
+
+	model = Model(data, feature_mapping)
+	model.weight_vector[:] = np.random.default_rng(args.seed).normal(size=len(model.weight_vector))		# Scores as after training
+	model.weight_vector[-1] = 0
+	scores = benchmark.run("edge_scores", tokens, lambda: [model.edge_scores(sentence, feature_index[i]) for i, sentence in enumerate(sentences)])
+	for name in sorted(DECODERS):
+		decoder = DECODERS[name]()
+		benchmark.run("decode:" + name, tokens, lambda: [decoder.decode(edge_scores) for edge_scores in scores])
+		benchmark.run("decode_batch:" + name, tokens, lambda: [tree for start in range(0, len(scores), args.batch_size) for tree in decoder.decode_batch(scores[start:start+args.batch_size])])
+	del scores
+
+	model.weight_vector[:] = 0
+	benchmark.run("train_epoch", tokens, model.train, 1, feature_index, 1, None, args.seed)
+	benchmark.run("make_predictions", tokens, model.make_predictions, data, args.batch_size)
+
+	return {
+		"commit": git_commit(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"config": {"sentences": args.sentences, "lengths": args.lengths, "seed": args.seed, "hash_bits": args.hash_bits, "batch_size": args.batch_size, "tracemalloc": args.tracemalloc},
+		"corpus": {"sentences": len(sentences), "tokens": tokens, "arcs": arc_count, "max_length": max(len(sentence) - 1 for sentence in sentences)},
+		"stages": benchmark.stages,
+		"max_rss_mb": max_rss(),
+	}
+
+def compare(results, baseline, tolerance):
+	'''
+		Prints the speed of each stage relative to a baseline results dictionary.
+		Returns the stages that got slower than (1 - tolerance) times the baseline throughput.
+	'''
+	if results["config"] != baseline["config"]:
+		print("Warning: baseline was run with a different config:", baseline["config"], file=sys.stderr)
+	before = {stage["stage"]: stage for stage in baseline["stages"]}
+	regressions = []
+	for stage in results["stages"]:
+		if stage["stage"] not in before or not before[stage["stage"]]["tokens_per_second"] or not stage["tokens_per_second"]:
+			continue
+		ratio = stage["tokens_per_second"] / before[stage["stage"]]["tokens_per_second"]
+		flag = ""
+		if ratio < 1 - tolerance:
+			regressions.append(stage["stage"])
+			flag = "REGRESSION"
+		print(stage["stage"].ljust(24), "%6.2fx baseline speed" % ratio, flag, file=sys.stderr)
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark every stage of the dependency parser on a synthetic corpus.')
+	parser.add_argument('--sentences', type=int, default=2000, help='Sentences in the synthetic corpus.')
+	parser.add_argument('--lengths', type=str, default='lognormal:22:0.5', help='Sentence length distribution: fixed:N, uniform:MIN:MAX, normal:MEAN:SD or lognormal:MEAN:SIGMA.')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus and the benchmark weights.')
+	parser.add_argument('--hash_bits', type=int, help='Benchmark a hashed feature space instead of a feature map.')
+	parser.add_argument('--batch_size', type=int, default=32, help='Sentences per batch for batch decoding and predictions.')
+	parser.add_argument('--tracemalloc', action='store_true', help='Also trace the peak memory of each stage alone; slows down pure-Python stages a lot.')
+	parser.add_argument('--output', type=str, help='Write the results JSON here; stdout when not given.')
+	parser.add_argument('--baseline', type=str, help='Results JSON of an earlier run to compare against.')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='With --baseline, exit with status 1 if a stage is more than this share slower.')
+	args = parser.parse_args()
+
+	results = run_benchmark(args)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+	else:
+		json.dump(results, sys.stdout, indent=2)
+		print()
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		if regressions:
+			print("Slower than baseline:", ", ".join(regressions), file=sys.stderr)
+			sys.exit(1)
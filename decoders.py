@@ -0,0 +1,18 @@
+from eisner import Eisner
+from mst import ChuLiuEdmonds
+
+'''
+		Registry of the decoders a Model can use, by the name given on the command line and stored in model files.
+		A decoder is created with a max_length and has decode(edge_scores), decode_batch(edge_scores_list) and is_too_long(n);
+		edge_scores are indexed by [head, dependant] and the returned head arrays hold -1 for ROOT.
+'''
+
+DECODERS = {
+	"eisner": Eisner,		# Projective, O(n³)
+	"mst": ChuLiuEdmonds,		# Non-projective, O(n²) per contraction round
+}
+
+def make_decoder(name, max_length=1024):
+	if name not in DECODERS:
+		raise ValueError("Unknown decoder " + repr(name) + "; choose from " + ", ".join(DECODERS))
+	return DECODERS[name](max_length)
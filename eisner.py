@@ -8,100 +8,177 @@ class Eisner:
 
 	'''
 			Class object for the decoder using Eisner's algorithm.
+			Keeps one workspace of flat buffers, sized in cells (B * n * n) to the largest batch decoded so far,
+			and reshapes their fronts for each batch, so decoding stops allocating once the largest batch has been seen.
+			Scores are float32 like Model.edge_scores; backpointers are int16 when max_length allows.
+			Sentences longer than max_length are not decoded (None for no limit):
+				too_long='chain' attaches every token to the one before it, too_long='error' raises a ValueError.
 	'''
 
+	max_cells = 1 << 20		# Most B * n * n decoded at once; larger buckets are split, so the workspace holds max(max_cells, max_length**2) cells
+
+	def __init__(self, max_length=1024, too_long='chain'):
+		if too_long not in ('chain', 'error'):
+			raise ValueError("too_long must be 'chain' or 'error'")
+		self.max_length = max_length
+		self.too_long = too_long
+		if max_length is not None and max_length <= np.iinfo(np.int16).max:
+			self.index_type = np.int16
+		else:
+			self.index_type = np.int32
+		self.capacity = 0		# B * n * n cells the workspace can hold
+		self.long_sentences = 0		# Sentences handled by the too_long policy
+
+	def is_too_long(self, n):
+		'''
+				True if a sentence of n tokens (ROOT included) is longer than max_length and gets a chain of heads;
+				raises a ValueError instead with too_long='error'. Callers can check this before scoring a sentence.
+		'''
+		if self.max_length is None or n <= self.max_length:
+			return False
+		if self.too_long == 'error':
+			raise ValueError("Sentence of " + str(n) + " tokens is longer than max_length " + str(self.max_length))
+		self.long_sentences += 1
+		return True
+
+	def workspace(self, B, n):
+		'''
+				Returns the scores, O, C, b_O and b_C workspace arrays for B sentences of length n, as contiguous
+				reshaped views of the front of flat buffers; the buffers grow first when they hold fewer than B * n * n cells.
+		'''
+		cells = B * n * n
+		if cells > self.capacity:
+			self.scores = np.empty(cells, dtype=np.float32)
+			self.O = np.empty(2 * cells, dtype=np.float32)
+			self.C = np.empty(2 * cells, dtype=np.float32)
+			self.b_O = np.empty(2 * cells, dtype=self.index_type)
+			self.b_C = np.empty(2 * cells, dtype=self.index_type)
+			self.capacity = cells
+		shape = [B, n, n, 2]
+		return (self.scores[:cells].reshape(shape[:3]), self.O[:2*cells].reshape(shape), self.C[:2*cells].reshape(shape),
+				self.b_O[:2*cells].reshape(shape), self.b_C[:2*cells].reshape(shape))
+
 	def decode(self, edge_scores):
 		'''
 				Calculates the best tree given an edge_scores matrix.
-				Returns a dictionary of arc tuples (head, dependant).
+				Returns an int array of heads indexed by dependant; the ROOT entry is -1.
+		'''
+		return self.decode_batch([edge_scores], bucket_width=1)[0]
+
+	def decode_batch(self, edge_scores_list, bucket_width=8):
 		'''
-		n=edge_scores.shape[0]		# Get shape of current sentence
-		best_tree = -np.ones(n, dtype=int)		# Init tree with negative values
-		
-		# Initialize matrices with zeros
-		# Left and right matrices combined with a third dimension -> direction
+				Calculates the best tree of every edge_scores matrix in a list.
+				Returns a list of head arrays as decode does, in input order.
+
+				Sentences are grouped by length rounded up to a multiple of bucket_width,
+				and every group is decoded at once by decode_padded, at most max_cells at a time.
+		'''
+		trees = [None] * len(edge_scores_list)
+		buckets = {}
+		for i, edge_scores in enumerate(edge_scores_list):
+			n = edge_scores.shape[0]
+			if self.is_too_long(n):
+				trees[i] = np.arange(-1, n-1)		# Every token attached to the one before it
+				continue
+			size = -(-n // bucket_width) * bucket_width		# Length rounded up
+			buckets.setdefault(size, []).append(i)
+		for size, bucket in buckets.items():
+			batch_size = max(1, self.max_cells // (size * size))
+			for start in range(0, len(bucket), batch_size):
+				indices = bucket[start:start+batch_size]
+				padded = self.workspace(len(indices), size)[0]
+				padded.fill(-np.inf)
+				padded[:, np.arange(size-1), np.arange(1, size)] = 0		# Padding token j can only attach to j-1, at no cost
+				for b, i in enumerate(indices):
+					n = edge_scores_list[i].shape[0]
+					padded[b, :n, :n] = edge_scores_list[i]
+				for i, tree in zip(indices, self.decode_padded(padded)):
+					trees[i] = tree[:edge_scores_list[i].shape[0]]
+		return trees
+
+	def decode_padded(self, edge_scores):
+		'''
+				Calculates the best tree of each of B sentences at once, given a (B, n, n) array of edge_scores.
+				Returns a (B, n) int array of heads.
+				Shorter sentences are padded with tokens whose only allowed arc comes from the token before,
+				so the padding always forms a chain after the real tree and does not change it.
+
+				All spans of the same width m of all sentences are computed at once, so the
+				Python loop runs n times instead of once per (sentence, m, s) triple.
+		'''
+		B, n = edge_scores.shape[:2]		# Get shape of current batch
+		best_trees = -np.ones([B, n], dtype=int)		# Init trees with negative values
+
+		# Workspace views; left and right matrices combined with a fourth dimension -> direction
 			# direction=1 -> right; direction=0 -> left
-		O = np.zeros([n, n, 2])
-		C = np.zeros([n, n, 2])
-
-		# Initialize backtracking matrices with negative integers
-		b_O = -np.ones([n, n, 2], dtype=int)
-		b_C = -np.ones([n, n, 2], dtype=int)
-		
-		# Iterating through m and s from pseudocode in lecture
+		# Every cell is written before it is read except the width-0 closed spans, which start at 0
+		O, C, b_O, b_C = self.workspace(B, n)[1:]
+		C[:, np.arange(n), np.arange(n)] = 0
+
+		# Iterating through span widths m; every start s of width m handled at once
 		for m in np.arange(1, n):
-			for s in np.arange(0, n-m):
-				t = s+m
-
-				# max_vals from pseudocode matrices compiled into O and C 3-dim matrices
-				# O_l
-				O_l_list = C[s, s:t, 1] + C[s+1:t+1, t, 0] + edge_scores[t, s]
-				O[s, t, 0] = np.max(O_l_list)
-				b_O[s, t, 0] = s + np.argmax(O_l_list)
-
-				# O_r
-				O_r_list = C[s, s:t, 1] + C[s+1:t+1, t, 0] + edge_scores[s, t]
-				O[s, t, 1] = np.max(O_r_list)
-				b_O[s, t, 1] = s + np.argmax(O_r_list)
-					
-				# C_l
-				C_l_list = C[s, s:t, 0] + O[s:t, t, 0]
-				C[s, t, 0] = np.max(C_l_list)
-				b_C[s, t, 0] = s + np.argmax(C_l_list)
-								
-				# C_r
-				C_r_list = O[s, s+1:t+1, 1] + C[s+1:t+1, t, 1]
-				C[s, t, 1] = np.max(C_r_list)
-				b_C[s, t, 1] = s + 1 + np.argmax(C_r_list)
+			s = np.arange(0, n-m)		# All span starts
+			t = s + m		# All span ends
+			r = s[:, None] + np.arange(m)		# Split points s..t-1 for each span; shape (n-m, m)
+
+			# O_l and O_r share the same split sums; only the arc score added differs
+			O_list = C[:, s[:, None], r, 1] + C[:, r+1, t[:, None], 0]		# Shape (B, n-m, m)
+			O_best = np.argmax(O_list, axis=2)
+			O_max = np.take_along_axis(O_list, O_best[..., None], axis=2)[..., 0]
+			O[:, s, t, 0] = O_max + edge_scores[:, t, s]		# O_l
+			O[:, s, t, 1] = O_max + edge_scores[:, s, t]		# O_r
+			b_O[:, s, t, 0] = s + O_best
+			b_O[:, s, t, 1] = s + O_best
+
+			# C_l
+			C_l_list = C[:, s[:, None], r, 0] + O[:, r, t[:, None], 0]
+			C_l_best = np.argmax(C_l_list, axis=2)
+			C[:, s, t, 0] = np.take_along_axis(C_l_list, C_l_best[..., None], axis=2)[..., 0]
+			b_C[:, s, t, 0] = s + C_l_best
+
+			# C_r
+			C_r_list = O[:, s[:, None], r+1, 1] + C[:, r+1, t[:, None], 1]
+			C_r_best = np.argmax(C_r_list, axis=2)
+			C[:, s, t, 1] = np.take_along_axis(C_r_list, C_r_best[..., None], axis=2)[..., 0]
+			b_C[:, s, t, 1] = s + 1 + C_r_best
 
 		# Initiate backtracking with closed-right matrix
-		self.backtrack(b_O, b_C, 0, n-1, 1, 1, best_tree)
-
-		# Init calculated arcs
-		arcs = {}
-		
-		# Iterate through length of the tree
-		for dep in np.arange(len(best_tree)):		# Dependants are unique
-			if dep == 0:    # Skip root
-				continue
-			else:
-				head = best_tree[dep]		# Add head to tree at dep_index
-				arcs[str(dep)] = str(head)		# Add head to arcs[dep] for reference
-		
-		return arcs
+		for b in range(B):
+			self.backtrack(b_O[b], b_C[b], n-1, best_trees[b])
+
+		return best_trees
 
-	def backtrack(self, b_O, b_C, s, t, dir, structure, tree):
+	def backtrack(self, b_O, b_C, t, tree):
 		'''
-				Recursive backtracking function; calls return at points to stop recursion.
+				Iterative backtracking function; an explicit stack replaces recursion
+				so long sentences do not run into the recursion limit.
 
 				Inputs: - backtracking matrices for open and closed structures
-								- s and t for iteration through arcs
-								- direction (L=0/R=1) and structure (O=0/C=1)
-								- current tree
+								- t, the last token of the sentence
+								- current tree, updated in place
+
+				Stack items are (s, t, direction (L=0/R=1), structure (O=0/C=1)).
 		'''
-		if s == t:		# If at end of arcs
-			return
-
-		if structure == 1:		# Closed-structure backtracking
-			backpointer = b_C[s, t, dir]		# Get current backpointer for (s, t, direction)
-			if dir == 0:		# Left structure
-				# Recursive calls with backpointer to backtrack through best arcs
-				self.backtrack(b_O, b_C, s, backpointer, 0, 1, tree)
-				self.backtrack(b_O, b_C, backpointer, t, 0, 0, tree)
-				return
-			else:		# Right structure
-				self.backtrack(b_O, b_C, s, backpointer, 1, 0, tree)
-				self.backtrack(b_O, b_C, backpointer, t, 1, 1, tree)
-				return
-		else:		# Repeat above procedure for open-structure backtracking; update trees here
-			backpointer = b_O[s, t, dir]
-			if dir == 0:
-				tree[s] = t			# Update tree with arc (s, t)
-				self.backtrack(b_O, b_C, s, backpointer, 1, 1, tree)
-				self.backtrack(b_O, b_C, backpointer+1, t, 0, 1, tree)
-				return
-			else:
-				tree[t] = s			# Update tree with arc (t, s)
-				self.backtrack(b_O, b_C, s, backpointer, 1, 1, tree)
-				self.backtrack(b_O, b_C, backpointer+1, t, 0, 1, tree)
-				return
+		stack = [(0, t, 1, 1)]		# Start from the closed-right structure over the whole sentence
+		while stack:
+			s, t, dir, structure = stack.pop()
+			if s == t:		# If at end of arcs
+				continue
+
+			if structure == 1:		# Closed-structure backtracking
+				backpointer = b_C[s, t, dir]		# Get current backpointer for (s, t, direction)
+				if dir == 0:		# Left structure
+					stack.append((s, backpointer, 0, 1))
+					stack.append((backpointer, t, 0, 0))
+				else:		# Right structure
+					stack.append((s, backpointer, 1, 0))
+					stack.append((backpointer, t, 1, 1))
+			else:		# Repeat above procedure for open-structure backtracking; update trees here
+				backpointer = b_O[s, t, dir]
+				if dir == 0:
+					tree[s] = t			# Update tree with arc (s, t)
+				else:
+					tree[t] = s			# Update tree with arc (t, s)
+				stack.append((s, backpointer, 1, 1))
+				stack.append((backpointer+1, t, 0, 1))
+		return tree
@@ -0,0 +1,137 @@
+import numpy as np
+
+from IO import POS, HEAD, DEPREL, vocabulary
+from instrument import length_bucket
+
+'''
+	Script with the evaluation of predicted heads against gold heads: UAS, LAS and their breakdown
+	by sentence length, arc distance and POS, computed on flat int arrays of the whole corpus at once.
+'''
+
+DISTANCE_EDGES = [2, 3, 4, 5, 6, 11]		# Distance buckets: 1, 2, 3, 4, 5, 6-10 and 11+
+DISTANCE_NAMES = ["1", "2", "3", "4", "5", "6-10", "11+"]
+
+class Evaluation:
+
+	'''
+		Scores of one corpus; every token except ROOT whose gold head is known ('_' heads are skipped).
+		Per-token arrays, concatenated over every sentence:
+		.correct -> bool array; predicted head is the gold head
+		.labelled -> bool array; also the same label, or None when there are no predicted labels
+		.lengths, .distances, .tags -> sentence length (ROOT excluded), gold arc distance (0 for ROOT arcs)
+			and gold POS vocabulary id of every token, to break the scores down by
+		Without predicted_sentences, the heads predicted by the Model (sentence.predicted) are scored;
+		the parser predicts no labels, so there is no LAS then. With predicted_sentences (ie. read from a .pred file),
+		their head and label columns are scored and they must hold the same tokens as gold_sentences;
+		there is no LAS either when every predicted label is '_', as in the parser's own .pred files.
+	'''
+
+	def __init__(self, gold_sentences, predicted_sentences=None):
+		if not gold_sentences:
+			raise ValueError("No sentences to evaluate")
+		if predicted_sentences is not None and len(predicted_sentences) != len(gold_sentences):
+			raise ValueError("Gold has " + str(len(gold_sentences)) + " sentences, predictions " + str(len(predicted_sentences)))
+		gold = np.concatenate([sentence.columns[1:] for sentence in gold_sentences])
+		lengths = np.array([len(sentence) - 1 for sentence in gold_sentences], dtype=np.int64)
+		if predicted_sentences is None:
+			predicted_heads = np.concatenate([sentence.predicted[1:] for sentence in gold_sentences])
+			predicted_labels = None
+		else:
+			predicted_lengths = np.array([len(sentence) - 1 for sentence in predicted_sentences], dtype=np.int64)
+			mismatch = np.flatnonzero(predicted_lengths != lengths)
+			if len(mismatch):
+				raise ValueError("Sentence " + str(mismatch[0] + 1) + " has " + str(lengths[mismatch[0]]) + " gold tokens but " + str(predicted_lengths[mismatch[0]]) + " predicted")
+			predicted = np.concatenate([sentence.columns[1:] for sentence in predicted_sentences])
+			predicted_heads, predicted_labels = predicted[:, HEAD], predicted[:, DEPREL]
+			if np.all(predicted_labels == vocabulary.index('_')):		# Unlabelled predictions
+				predicted_labels = None
+
+		gold_heads = gold[:, HEAD]
+		dependants = np.arange(len(gold)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1		# Token index within its sentence
+		known = gold_heads >= 0
+		self.sentence_count = len(gold_sentences)
+		self.correct = (predicted_heads == gold_heads)[known]
+		self.labelled = None if predicted_labels is None else (self.correct & (predicted_labels == gold[:, DEPREL])[known])
+		self.lengths = np.repeat(lengths, lengths)[known]
+		self.distances = np.where(gold_heads == 0, 0, np.abs(gold_heads - dependants))[known]
+		self.tags = gold[:, POS][known]
+
+	def __len__(self):		# Number of scored tokens
+		return len(self.correct)
+
+	@property
+	def uas(self):
+		return float(self.correct.mean()) if len(self) else None
+
+	@property
+	def las(self):
+		if self.labelled is None or not len(self):
+			return None
+		return float(self.labelled.mean())
+
+	def breakdown(self, groups, names):
+		'''
+			Scores per group, given the group index of every token and the group names; empty groups are left out.
+		'''
+		tokens = np.bincount(groups, minlength=len(names))
+		correct = np.bincount(groups, weights=self.correct, minlength=len(names))
+		labelled = None if self.labelled is None else np.bincount(groups, weights=self.labelled, minlength=len(names))
+		scores = {}
+		for group in np.flatnonzero(tokens):
+			scores[names[group]] = {"tokens": int(tokens[group]), "uas": float(correct[group] / tokens[group]), "las": None if labelled is None else float(labelled[group] / tokens[group])}
+		return scores
+
+	def by_length(self):
+		'''
+			Scores per power-of-two sentence length bucket (see instrument.length_bucket).
+		'''
+		unique, groups = np.unique(self.lengths, return_inverse=True)
+		buckets = [length_bucket(length) for length in unique]
+		names = sorted(set(buckets), key=lambda bucket: int(bucket.split("-")[0]))
+		return self.breakdown(np.array([names.index(bucket) for bucket in buckets], dtype=np.int64)[groups], names)
+
+	def by_distance(self):
+		'''
+			Scores per gold arc distance bucket; "root" for the arcs from ROOT.
+		'''
+		groups = np.where(self.distances == 0, len(DISTANCE_NAMES), np.digitize(self.distances, DISTANCE_EDGES))
+		return self.breakdown(groups, DISTANCE_NAMES + ["root"])
+
+	def by_pos(self):
+		'''
+			Scores per gold POS of the dependant, most frequent first.
+		'''
+		unique, groups = np.unique(self.tags, return_inverse=True)
+		scores = self.breakdown(groups, [vocabulary.strings[tag] for tag in unique])
+		return dict(sorted(scores.items(), key=lambda item: -item[1]["tokens"]))
+
+	def report(self):
+		'''
+			Every score as a dictionary, ie. for JSON.
+		'''
+		return {
+			"sentences": self.sentence_count,
+			"tokens": len(self),
+			"uas": self.uas,
+			"las": self.las,
+			"by_length": self.by_length(),
+			"by_distance": self.by_distance(),
+			"by_pos": self.by_pos(),
+		}
+
+	def format(self):
+		'''
+			The report as a plain text table.
+		'''
+		report = self.report()
+		lines = ["Tokens: " + str(report["tokens"]) + " in " + str(report["sentences"]) + " sentences",
+				 "UAS: " + format_score(report["uas"]) + "  LAS: " + format_score(report["las"])]
+		for title, key in [("Sentence length", "by_length"), ("Distance", "by_distance"), ("POS", "by_pos")]:
+			lines.append("")
+			lines.append(title.ljust(16) + "tokens".rjust(9) + "UAS".rjust(9) + "LAS".rjust(9))
+			for name, scores in report[key].items():
+				lines.append(name.ljust(16) + str(scores["tokens"]).rjust(9) + format_score(scores["uas"]).rjust(9) + format_score(scores["las"]).rjust(9))
+		return "\n".join(lines)
+
+def format_score(score):
+	return "-" if score is None else "%.2f" % (100 * score)
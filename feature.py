@@ -1,6 +1,33 @@
+import os, hashlib, shutil, zlib
 import timeit
 import numpy as np
 
+from IO import Reader, FORM, POS
+from parallel import pool_context, chunked, ordered_imap
+from instrument import metrics
+
+# Feature templates to be used
+FEATURE_TEMPLATES = ["hform", "hpos", "dform", "dpos", "hform, hpos", "dform, dpos",   # Unigram features
+					 "hform, hpos, dform, dpos",                                       # Bigram features
+					 "hpos, dform, dpos", "hform, dform, dpos", 
+					 "hform, hpos, dform", "hform, hpos, dpos", 
+					 "hform, dform", "hpos, dpos", 
+					 "hpos, dpos, hpos+1, dpos-1", "hpos, dpos, hpos-1, dpos-1", 		# 'Other' features
+					 "hpos, dpos, hpos-1, dpos+1", "hpos, bpos, dpos"]
+
+# FeatureMapping used by map-building worker processes; set once per worker by set_worker_mapping
+worker_mapping = None
+
+def set_worker_mapping(feature_mapping):
+	global worker_mapping
+	worker_mapping = feature_mapping
+
+def count_chunk(sentences):
+	'''
+		Worker task: feature counts of a chunk of sentences, in first-seen order, and the worker's stage timings.
+	'''
+	return worker_mapping.count_features(sentences), metrics.take()
+
 class FeatureMapping:
 	
 	'''
@@ -11,32 +38,57 @@ class FeatureMapping:
 			keys = feature_name, values = feature_vector_id
 				ex. feature_name = 'hform=likes'
 					feature_vector_id = 1
+		With hash_bits set, .map stays empty and feature_vector_id is a stable hash
+		of feature_name into 2**hash_bits buckets; no create_map pass is needed.
 	'''
-	
-	def __init__(self, sentences):
+
+	# Class defaults so models pickled before these options existed still load
+	hash_bits = None
+	min_count = 1
+	gold_only = False
+
+	def __init__(self, sentences, hash_bits=None, min_count=1, gold_only=False):
 		'''
 			Initialize with a list of sentences before training.
+			hash_bits (ie. 22 for 2**22 weights) switches to the hashed feature space.
+			min_count drops features seen fewer times while mapping; gold_only maps the features of gold arcs only.
 		'''
+		if hash_bits is not None and not 1 <= hash_bits <= 30:		# Ids and the sentinel must fit in int32
+			raise ValueError("hash_bits must be between 1 and 30, got " + str(hash_bits))
 		self.sentences = sentences
 		self.map = {}		# Feature map dictionary
 		self.vector_id = 0	# Current vector_id; updated during population
 		self.frozen = False       # False when populating; set to True after fully populated with training data
+		self.hash_bits = hash_bits
+		self.min_count = min_count
+		self.gold_only = gold_only
+		if hash_bits is not None:
+			self.frozen = True		# Nothing to populate
 	
-	def create_features(self, sentence, arc):
+	def sentence_values(self, sentence):
+		'''
+			Helper function to look up the form and POS strings of a sentence once,
+			instead of once per arc in create_features.
+		'''
+		return sentence.strings(FORM), sentence.strings(POS)
+
+	def create_features(self, sentence, arc, values=None):
 		'''
 			Helper function to create full feature names given a specific arc in a sentence.
 
-			Inputs: - Sentence object of Tokens
-					- arc tuple (head, dependant)
+			Inputs: - Sentence object
+					- arc tuple (head, dependant) of ints
+					- values, the result of sentence_values(sentence); looked up when not given
 
 			Feature templates used are specified in the feature_templates list
 			Vector_ids corresponding to relevant features of the arc specified in the features list
 		'''
+		if values is None:
+			values = self.sentence_values(sentence)
+		forms, tags = values
 
-		# Get int and str versions of head/dependant ids for ease of use
-		head_id = int(arc[0]); dep_id = int(arc[1])
-		head = sentence.tokens[head_id]; dep = sentence.tokens[dep_id]
-		final = len(sentence.tokens) - 1		# To stop from going out of index bounds
+		head_id, dep_id = arc
+		final = len(sentence) - 1		# To stop from going out of index bounds
 		
 		# Get arc's direction
 		if head_id > dep_id:
@@ -45,57 +97,47 @@ class FeatureMapping:
 			direction = "R"
 
 		# Get arc's distance
-		distance = str(abs(head_id - dep_id))
+		distance = abs(head_id - dep_id)
 
 		# Create basic constituent feature template values
-		hform = "_NULL_" if head.form == "_" else head.form
-		hpos = "_NULL_" if head.pos == "_" else head.pos
-		dform = "_NULL_" if dep.form == "_" else dep.form
-		dpos = "_NULL_" if dep.pos == "_" else dep.pos
+		hform = "_NULL_" if forms[head_id] == "_" else forms[head_id]
+		hpos = "_NULL_" if tags[head_id] == "_" else tags[head_id]
+		dform = "_NULL_" if forms[dep_id] == "_" else forms[dep_id]
+		dpos = "_NULL_" if tags[dep_id] == "_" else tags[dep_id]
 		bpos = ""
 
 		# Right arc; get hpos_plus1 and dpos_minus1 easily
 		if direction == "R":
-			hpos_minus1 = "_NULL_" if head_id == 0 else sentence.tokens[head_id-1].pos
-			hpos_plus1 = sentence.tokens[head_id+1].pos
-			dpos_minus1 = sentence.tokens[dep_id-1].pos
-			dpos_plus1 = "_NULL_" if dep_id == final else sentence.tokens[dep_id+1].pos
+			hpos_minus1 = "_NULL_" if head_id == 0 else tags[head_id-1]
+			hpos_plus1 = tags[head_id+1]
+			dpos_minus1 = tags[dep_id-1]
+			dpos_plus1 = "_NULL_" if dep_id == final else tags[dep_id+1]
 		# Left arc; get hpos_minus1 and dpos_plus1 easily
 		else:
-			hpos_minus1 = sentence.tokens[head_id-1].pos
-			hpos_plus1 = "_NULL_" if head_id == final else sentence.tokens[head_id+1].pos
-			dpos_minus1 = "_NULL_" if dep_id == 0 else sentence.tokens[dep_id-1].pos
-			dpos_plus1 = sentence.tokens[dep_id+1].pos
+			hpos_minus1 = tags[head_id-1]
+			hpos_plus1 = "_NULL_" if head_id == final else tags[head_id+1]
+			dpos_minus1 = "_NULL_" if dep_id == 0 else tags[dep_id-1]
+			dpos_plus1 = tags[dep_id+1]
 
 		# If head and dep are not next to each other
-		if int(distance) > 0:
+		# bpos limited to the last detected 'between' token, ie. the one next to the right-hand end
+		if distance > 1:
 			if direction == "R":
-				for i in np.arange(1, int(distance)):
-					bpos = sentence.tokens[head_id+i].pos
+				bpos = tags[dep_id-1]
 			else:
-				for i in np.arange(1, int(distance)):
-					bpos = sentence.tokens[dep_id+i].pos
-		# bpos limited to the last detected 'between' token
+				bpos = tags[head_id-1]
+		distance = str(distance)
 
 		# Dictionary to refer to above values
 		feature_dict = {"hform": hform, "hpos": hpos, "dform": dform, "dpos": dpos, 
 						"hpos-1": hpos_minus1, "hpos+1": hpos_plus1, "dpos-1": dpos_minus1, 
 						"dpos+1": dpos_plus1, "bpos": bpos}
 
-		# Feature templates to be used
-		feature_templates = ["hform", "hpos", "dform", "dpos", "hform, hpos", "dform, dpos",   # Unigram features
-							 "hform, hpos, dform, dpos",                                       # Bigram features
-							 "hpos, dform, dpos", "hform, dform, dpos", 
-							 "hform, hpos, dform", "hform, hpos, dpos", 
-							 "hform, dform", "hpos, dpos", 
-							 "hpos, dpos, hpos+1, dpos-1", "hpos, dpos, hpos-1, dpos-1", 		# 'Other' features
-							 "hpos, dpos, hpos-1, dpos+1", "hpos, bpos, dpos"]
-		
 		# Initialize feature list
 		full_features = []
 		
 		# Creating full feature values
-		for feature_template in feature_templates:
+		for feature_template in FEATURE_TEMPLATES:
 			full_feature = ""    # init as empty string
 			full_feature_components = [feature_template, "="]    # populate with template and =
 			sub_features = feature_template.split(", ")    # For features with multiple constituents
@@ -125,27 +167,88 @@ class FeatureMapping:
 			
 		return full_features
 	
-	def create_map(self):
+	def create_map(self, sentences=None, processes=1, chunk_size=1000):
 		'''
-			Creates feature map for all sentences and arcs of self.sentences
+			Creates feature map for all sentences and arcs of self.sentences, or of sentences when given
+			(any iterable, ie. a generator, so the corpus need not be in memory).
+			Features are counted first; those seen at least self.min_count times get ids in first-seen order.
+			With processes > 1, chunks of chunk_size sentences are counted in worker processes and merged
+			in chunk order, so the ids are the same as with one process.
 		'''
+		if self.hash_bits is not None or self.frozen:		# Hashed feature space has no map to create
+			return
+		if sentences is None:
+			sentences = self.sentences
+		counts = {}		# Feature counts in first-seen order
 		sentence_count = 0	# Keeping track of progress
 		starttime = timeit.default_timer()		# Timer
-		print("Start time: " + str(starttime))
-		for sentence in self.sentences:
-			sentence_count += 1
-			arcs = sentence.potential_arcs()		# Get all arcs of sentence
-			for arc in arcs:
-				# Iterate through full feature values for current sentence-arc
-				for feature in self.create_features(sentence, arc):
-					# If full_feature not in map and still populating (ie. self.frozen == False)
-					if feature not in self.map.keys() and self.frozen == False:
-						self.map[feature] = self.vector_id
-						self.vector_id += 1
-			if sentence_count % 1000 == 0:
-				print(sentence_count, "sentences took", (timeit.default_timer() - starttime), "to map")
-		
-		
+		metrics.reset()
+		if processes > 1:
+			worker_mapping = FeatureMapping([], gold_only=self.gold_only)		# Only needs create_features
+			with pool_context().Pool(processes, initializer=set_worker_mapping, initargs=(worker_mapping,)) as pool:
+				for chunk, (chunk_counts, timings) in ordered_imap(pool, count_chunk, chunked(sentences, chunk_size), 2 * processes):
+					for feature, count in chunk_counts.items():
+						counts[feature] = counts.get(feature, 0) + count
+					metrics.merge(timings)		# Stage timings summed over the workers
+					sentence_count += len(chunk)
+					metrics.emit("progress", task="create_map", sentences=sentence_count, seconds=timeit.default_timer() - starttime)
+		else:
+			for chunk in chunked(sentences, chunk_size):
+				self.count_features(chunk, counts)
+				sentence_count += len(chunk)
+				metrics.emit("progress", task="create_map", sentences=sentence_count, seconds=timeit.default_timer() - starttime)
+		for feature, count in counts.items():
+			# If full_feature frequent enough and not in map yet
+			if count >= self.min_count and feature not in self.map:
+				self.map[feature] = self.vector_id
+				self.vector_id += 1
+		metrics.emit("create_map", seconds=timeit.default_timer() - starttime, sentences=sentence_count, counted=len(counts), features=len(self.map), **metrics.take())
+
+	def extend(self, sentences, processes=1):
+		'''
+			Maps the features of sentences that are not in the map yet, with ids after the existing ones, so the ids
+			of a trained model stay valid (ie. to keep training a loaded model on new data). Returns the number added.
+		'''
+		before = self.num_features
+		self.frozen = False
+		self.create_map(sentences, processes)
+		self.frozen = True
+		return self.num_features - before
+
+	def count_features(self, sentences, counts=None):
+		'''
+			Counts the features of the mapped arcs of sentences into counts, in first-seen order.
+		'''
+		if counts is None:
+			counts = {}
+		for sentence in sentences:
+			with metrics.timer("count", len(sentence) - 1):
+				if self.gold_only:
+					arcs = [(head, dep) for dep, head in sentence.gold_arcs().items() if head >= 0]		# Skip unknown gold heads
+				else:
+					arcs = sentence.potential_arcs()		# Get all arcs of sentence; sorted so feature ids are the same on every run
+				values = self.sentence_values(sentence)
+				for arc in arcs:
+					# Iterate through full feature values for current sentence-arc
+					for feature in self.create_features(sentence, arc, values):
+						counts[feature] = counts.get(feature, 0) + 1
+		return counts
+
+	def prune(self, weight_vector):
+		'''
+			Drops features whose weight is 0 and renumbers the rest, keeping their order.
+			Returns the matching smaller weight vector, with the unknown_id weight at the end.
+			The hashed feature space cannot be renumbered and is returned unchanged.
+		'''
+		if self.hash_bits is not None:
+			return weight_vector
+		weight_vector = np.asarray(weight_vector)
+		keys = sorted(self.map, key=self.map.get)		# Keys in vector_id order
+		keep = np.flatnonzero(weight_vector[:len(keys)])
+		self.map = {keys[vector_id]: new_id for new_id, vector_id in enumerate(keep)}
+		self.vector_id = len(self.map)
+		return np.append(weight_vector[keep], np.float32(0)).astype(np.float32)
+
 	def extract_features(self, sentence, arc):
 		'''
 			Feature extraction for a particular arc; used during training and validation/testing
@@ -154,10 +257,142 @@ class FeatureMapping:
 		# Init vectors for current arc
 		feature_vectors = []
 		
-		for feature in self.create_features(sentence, arc):
-			if feature in self.map.keys():		# Check if feature exists ie. for unknown dev/test features
-				feature_vectors.append(self.map[feature])
+		for vector_id in self.lookup(self.create_features(sentence, arc)):
+			if vector_id != self.unknown_id:		# Check if feature exists ie. for unknown dev/test features
+				feature_vectors.append(vector_id)
 			else:
 				continue		# Skip for unknown features
 
 		return feature_vectors
+
+	def lookup(self, features):
+		'''
+			Returns the feature_vector_id of each full feature name; unknown_id for unknown features.
+		'''
+		if self.hash_bits is not None:
+			mask = (1 << self.hash_bits) - 1
+			# crc32 is stable across runs, unlike the salted built-in hash()
+			return [zlib.crc32(feature.encode("utf-8")) & mask for feature in features]
+		unknown = self.unknown_id
+		return [self.map.get(feature, unknown) for feature in features]
+
+	@property
+	def num_features(self):
+		'''
+			Size of the feature space; the weight vector holds one more entry for unknown_id.
+		'''
+		if self.hash_bits is not None:
+			return 1 << self.hash_bits
+		return len(self.map)
+
+	@property
+	def unknown_id(self):
+		'''
+			Sentinel feature id used for unknown features and impossible arcs.
+			The Model keeps an extra weight fixed at 0 at this index.
+		'''
+		return self.num_features
+
+	def feature_ids(self, sentence, mask=None):
+		'''
+			Builds the feature ids of every potential arc of a sentence at once.
+
+			Returns an int32 array of shape (n, n, T) indexed by [head, dependant, template],
+			where T = len(FEATURE_TEMPLATES). Unknown features, arcs into ROOT and
+			self-loops hold self.unknown_id, so they score 0 in Model.edge_scores.
+			With an (n, n) boolean mask (see ArcPruner.mask), only the arcs it keeps are extracted;
+			the others hold self.unknown_id too.
+		'''
+		n = len(sentence)
+		ids = np.full([n, n, len(FEATURE_TEMPLATES)], self.unknown_id, dtype=np.int32)
+		values = self.sentence_values(sentence)
+		arcs = sentence.potential_arcs() if mask is None else np.argwhere(mask).tolist()
+		for head, dep in arcs:
+			ids[head, dep] = self.lookup(self.create_features(sentence, (head, dep), values))
+		return ids
+
+class FeatureIndex:
+
+	'''
+		Corpus-level feature index in CSR form; built once and reused across epochs and runs.
+		.ids -> flat int32 array of the feature_ids of every sentence, one after another
+		.offsets -> int64 array; sentence i owns ids[offsets[i]:offsets[i+1]]
+		.lengths -> int32 array of sentence lengths (ROOT included)
+		Saved as .npy files plus the feature map keys, and memory-mapped when loaded.
+	'''
+
+	version = "1"		# Bump when the cache layout or feature extraction changes
+
+	def __init__(self, ids, offsets, lengths):
+		self.ids = ids
+		self.offsets = offsets
+		self.lengths = lengths
+
+	def __len__(self):
+		return len(self.lengths)
+
+	def __getitem__(self, i):
+		'''
+			Returns the (n, n, T) feature ids of sentence i as a view into self.ids.
+		'''
+		n = self.lengths[i]
+		return self.ids[self.offsets[i]:self.offsets[i+1]].reshape(n, n, len(FEATURE_TEMPLATES))
+
+	@staticmethod
+	def cache_key(filepath, feature_mapping):
+		'''
+			Hash of the training file(s) contents, the feature template set and the feature space options.
+		'''
+		digest = hashlib.sha1()
+		digest.update(("\n".join(FEATURE_TEMPLATES) + "\n" + FeatureIndex.version + "\n").encode("utf-8"))
+		digest.update(("hash_bits=" + str(feature_mapping.hash_bits) + "\n").encode("utf-8"))
+		digest.update(("min_count=" + str(feature_mapping.min_count) + " gold_only=" + str(feature_mapping.gold_only) + "\n").encode("utf-8"))
+		for path in Reader(filepath).filepaths():		# Every file of a list or glob, in reading order
+			with open(path, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 20), b""):
+					digest.update(block)
+		return digest.hexdigest()
+
+	@classmethod
+	def build(cls, feature_mapping, sentences):
+		'''
+			Extracts the feature ids of every sentence with a populated feature_mapping.
+		'''
+		lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int32)
+		offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+		np.cumsum(lengths.astype(np.int64)**2 * len(FEATURE_TEMPLATES), out=offsets[1:])
+		ids = np.empty(offsets[-1], dtype=np.int32)
+		for i, sentence in enumerate(sentences):
+			ids[offsets[i]:offsets[i+1]] = feature_mapping.feature_ids(sentence).ravel()
+		return cls(ids, offsets, lengths)
+
+	def save(self, directory, feature_mapping):
+		'''
+			Writes the index and the feature map keys to directory.
+			Written to a temporary directory first so an interrupted save is never loaded.
+		'''
+		tmp_directory = directory + ".tmp"
+		shutil.rmtree(tmp_directory, ignore_errors=True)
+		os.makedirs(tmp_directory)
+		np.save(os.path.join(tmp_directory, "ids.npy"), self.ids)
+		np.save(os.path.join(tmp_directory, "offsets.npy"), self.offsets)
+		np.save(os.path.join(tmp_directory, "lengths.npy"), self.lengths)
+		keys = sorted(feature_mapping.map, key=feature_mapping.map.get)		# Keys in id order
+		with open(os.path.join(tmp_directory, "map.txt"), 'w', encoding="utf-8") as f:
+			for key in keys:
+				f.write(key + "\n")
+		shutil.rmtree(directory, ignore_errors=True)
+		os.replace(tmp_directory, directory)
+
+	@classmethod
+	def load(cls, directory, feature_mapping):
+		'''
+			Memory-maps a saved index and restores feature_mapping.map, so create_map can be skipped.
+		'''
+		with open(os.path.join(directory, "map.txt"), encoding="utf-8") as f:
+			feature_mapping.map = {line[:-1]: vector_id for vector_id, line in enumerate(f)}
+		feature_mapping.vector_id = len(feature_mapping.map)
+		ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode='r')
+		offsets = np.load(os.path.join(directory, "offsets.npy"))
+		lengths = np.load(os.path.join(directory, "lengths.npy"))
+		return cls(ids, offsets, lengths)
@@ -0,0 +1,164 @@
+import sys, json, time, signal, cProfile, pstats, collections, contextlib
+
+'''
+	Script with the instrumentation shared by every task: stage timings written as JSON lines,
+	and profilers to run a whole task under.
+'''
+
+def length_bucket(length):
+	'''
+		Power-of-two bucket of a sentence length (ROOT excluded), ie. "9-16".
+	'''
+	upper = 8
+	while upper < length:
+		upper *= 2
+	return "1-8" if upper == 8 else str(upper // 2 + 1) + "-" + str(upper)
+
+class Metrics:
+
+	'''
+		Accumulates the time spent per stage, overall and per sentence-length bucket, and writes events
+		as JSON lines (one object per line, with "event" and "time" keys) to a stream once open is called.
+		Without a stream, timings are still accumulated but events are dropped.
+		Stages used by the parser: features, scoring, decoding, update (training) and count (create_map).
+	'''
+
+	def __init__(self):
+		self.stream = None
+		self.reset()
+
+	def open(self, filepath):
+		'''
+			Starts writing events to filepath; '-' is stderr. Events are appended.
+		'''
+		self.stream = sys.stderr if filepath == '-' else open(filepath, 'a', encoding='utf-8')
+
+	def reset(self):
+		self.stages = collections.defaultdict(lambda: [0.0, 0])		# stage -> [seconds, calls]
+		self.buckets = collections.defaultdict(lambda: collections.defaultdict(float))		# length bucket -> stage -> seconds
+
+	@contextlib.contextmanager
+	def timer(self, stage, length=None):
+		'''
+			Adds the time spent in the with block to stage, and to the length bucket of length when given.
+		'''
+		starttime = time.perf_counter()
+		try:
+			yield
+		finally:
+			seconds = time.perf_counter() - starttime
+			totals = self.stages[stage]
+			totals[0] += seconds
+			totals[1] += 1
+			if length is not None:
+				self.buckets[length_bucket(length)][stage] += seconds
+
+	def snapshot(self):
+		'''
+			Returns the accumulated timings as a dictionary.
+		'''
+		return {
+			"stages": {stage: {"seconds": seconds, "calls": calls} for stage, (seconds, calls) in list(self.stages.items())},		# list() as another thread may be adding stages
+			"buckets": {bucket: dict(stages) for bucket, stages in sorted(list(self.buckets.items()), key=lambda item: int(item[0].split("-")[0]))},
+		}
+
+	def take(self):
+		'''
+			Returns the accumulated timings as a dictionary and starts over.
+		'''
+		timings = self.snapshot()
+		self.reset()
+		return timings
+
+	def merge(self, timings):
+		'''
+			Adds timings from take(), ie. returned by a worker process.
+		'''
+		for stage, totals in timings["stages"].items():
+			self.stages[stage][0] += totals["seconds"]
+			self.stages[stage][1] += totals["calls"]
+		for bucket, stages in timings["buckets"].items():
+			for stage, seconds in stages.items():
+				self.buckets[bucket][stage] += seconds
+
+	def emit(self, event, **values):
+		if self.stream is None:
+			return
+		self.stream.write(json.dumps(dict(event=event, time=time.time(), **values)) + "\n")
+		self.stream.flush()
+
+metrics = Metrics()		# Used by every module of the process; worker processes inherit and send back their own
+
+class SamplingProfiler:
+
+	'''
+		Statistical profiler: samples the Python stack of the main thread every interval seconds of CPU time
+		and counts each distinct stack. Overhead stays low however many calls the task makes,
+		so it can be left on for production runs. Worker processes are not sampled.
+		Written in the collapsed stack format ("outer;inner count" per line) read by flamegraph.pl and speedscope.
+	'''
+
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self.counts = collections.Counter()
+
+	def sample(self, signum, frame):
+		stack = []
+		while frame is not None:
+			stack.append(frame.f_code.co_filename.rsplit("/", 1)[-1] + ":" + frame.f_code.co_name)
+			frame = frame.f_back
+		self.counts[";".join(reversed(stack))] += 1
+
+	def start(self):
+		signal.signal(signal.SIGPROF, self.sample)
+		signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0, 0)
+		signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+	def write(self, filepath):
+		with open(filepath, 'w', encoding='utf-8') as f:
+			for stack, count in self.counts.most_common():
+				f.write(stack + " " + str(count) + "\n")
+
+	def summary(self, limit=20):
+		'''
+			Functions by share of samples in which they are running (self time).
+		'''
+		total = sum(self.counts.values()) or 1
+		leaves = collections.Counter()
+		for stack, count in self.counts.items():
+			leaves[stack.rsplit(";", 1)[-1]] += count
+		return "\n".join("%6.1f%%  %s" % (100 * count / total, function) for function, count in leaves.most_common(limit))
+
+@contextlib.contextmanager
+def profiled(filepath, profiler='cprofile'):
+	'''
+		Runs the with block under a profiler and writes its output to filepath; does nothing without a filepath.
+		profiler 'cprofile' writes pstats data (python -m pstats filepath), 'sample' a collapsed stack file
+		from SamplingProfiler. A summary goes to stderr either way.
+	'''
+	if filepath is None:
+		yield
+		return
+	if profiler == 'cprofile':
+		profile = cProfile.Profile()
+		profile.enable()
+		try:
+			yield
+		finally:
+			profile.disable()
+			profile.dump_stats(filepath)
+			pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(20)
+	elif profiler == 'sample':
+		profile = SamplingProfiler()
+		profile.start()
+		try:
+			yield
+		finally:
+			profile.stop()
+			profile.write(filepath)
+			print(profile.summary(), file=sys.stderr)
+	else:
+		raise ValueError("Unknown profiler " + repr(profiler))
@@ -1,19 +1,63 @@
 import argparse
-from utils import train_model, test_model
+from utils import train_model, update_model, test_model, evaluate_files, convert_model, serve_model
+from decoders import DECODERS
+from instrument import metrics, profiled
 
 ''' argparse functions and logic learned from documentation '''
 ''' https://docs.python.org/3/library/argparse.html '''
 
 parser = argparse.ArgumentParser(description='Train and make predictions with a dependency parser.')
-parser.add_argument('--task', choices=['train', 'test'], help='Train or test the parser.')
-parser.add_argument('--train_filepath', type=str, help='The filepath to whichever file you wish to train on.')
+parser.add_argument('--task', choices=['train', 'update', 'test', 'eval', 'convert', 'serve'], help='Train or test the parser, update a trained --model_filepath on new --train_filepath data, score --pred_filepath against the gold --test_filepath, convert a pickled --model_filepath to the model file format at --output_filepath, or serve --model_filepath over HTTP.')
+parser.add_argument('--train_filepath', type=str, nargs='+', help='The filepath(s) or glob to whichever file(s) you wish to train on; .gz, .bz2 and .xz are read directly.')
 parser.add_argument('--test_filepath', type=str, help='The filepath to whichever file you wish to test on.')
+parser.add_argument('--pred_filepath', type=str, help='Predictions to score against the gold --test_filepath with --task eval.')
+parser.add_argument('--output_filepath', type=str, help='Where to write predictions when testing; defaults to <test basename>.pred, - for stdout. Where to save an updated model; defaults to --model_filepath.')
+parser.add_argument('--stream', action='store_true', help='Parse and write test sentences one at a time as they are read (a --batch_size chunk at a time with --processes); --test_filepath - reads stdin.')
 parser.add_argument('--model_filepath', type=str, help='The filepath to and from your dependency parser.')
 parser.add_argument('--num_epochs', help='How many epochs if training?')
+parser.add_argument('--hash_bits', type=int, help='Use a hashed feature space of 2**hash_bits weights instead of a feature map, ie. 22.')
+parser.add_argument('--processes', type=int, default=1, help='How many worker processes to use.')
+parser.add_argument('--mix_every', type=int, help='With --processes when training, average worker weights after this many sentences per worker; default once per epoch.')
+parser.add_argument('--averaged', action='store_true', help='Train an averaged perceptron.')
+parser.add_argument('--seed', type=int, help='Random seed for shuffling during training.')
+parser.add_argument('--min_count', type=int, default=1, help='Only map features seen at least this many times in training.')
+parser.add_argument('--gold_only', action='store_true', help='Only map features of gold arcs.')
+parser.add_argument('--dev_filepath', type=str, help='Dev set parsed after every training epoch; training stops early when its UAS stops improving.')
+parser.add_argument('--patience', type=int, default=3, help='With --dev_filepath, epochs without dev improvement before training stops.')
+parser.add_argument('--resume', action='store_true', help='Continue training from the checkpoint written next to the model after every epoch.')
+parser.add_argument('--replay_filepath', type=str, nargs='+', help='When updating, mix a sample of these sentences (ie. the original training data) into the new data.')
+parser.add_argument('--replay_fraction', type=float, default=0.1, help='Share of the --replay_filepath sentences mixed in.')
+parser.add_argument('--eval_sample', type=int, help='Report the training UAS after every epoch on this many random sentences instead of all of them.')
+parser.add_argument('--prune', action='store_true', help='Drop zero-weight features from the model after training.')
+parser.add_argument('--arc_pruning', type=int, help='Learn an arc pruner keeping this many candidate heads per dependant when training; overrides it when testing.')
+parser.add_argument('--batch_size', type=int, help='Sentences decoded at once; when training, decoded with the same weights before updating (default 1), when testing default 32.')
+parser.add_argument('--max_length', type=int, help='When testing, sentences longer than this are not decoded; each token gets the previous one as head (default 1024).')
+parser.add_argument('--decoder', choices=sorted(DECODERS), help='Decoder to train with (default eisner; projective), saved with the model; overrides the saved one when testing. mst allows non-projective trees.')
+parser.add_argument('--metrics', type=str, help='Append JSON-lines progress and per-stage timings (overall and per sentence-length bucket) to this file; - for stderr.')
+parser.add_argument('--profile', type=str, help='Run the task under a profiler and write its output to this file.')
+parser.add_argument('--profiler', choices=['cprofile', 'sample'], default='cprofile', help='cprofile writes pstats data; sample has low overhead and writes collapsed stacks for flame graphs.')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to serve on.')
+parser.add_argument('--port', type=int, default=8080, help='Port to serve on; 0 picks a free one.')
+parser.add_argument('--socket', type=str, help='Serve on this Unix socket instead of a port.')
+parser.add_argument('--max_wait_ms', type=float, default=2.0, help='When serving, how long to wait for more requests to decode in the same batch.')
+parser.add_argument('--parse_cache', type=int, help='When testing or serving, remember the parses of this many sentences, so repeated sentences are parsed once.')
+parser.add_argument('--parse_cache_file', type=str, help='With --parse_cache, load the cache from this file and save it back when done.')
+parser.add_argument('--cache_dir', type=str, help='Directory to cache training features in (ie. .feature_cache), so later runs on the same files and options skip extraction; off by default. Each file and option set adds an index of about 68 * n^2 bytes per sentence, and nothing is evicted.')
 
 args = parser.parse_args()
+if args.metrics:
+		metrics.open(args.metrics)
 
-if args.task == 'train':
-		train_model(int(args.num_epochs), args.train_filepath, args.model_filepath)
-elif args.task == 'test':
-		test_model(args.model_filepath, args.test_filepath)
+with profiled(args.profile, args.profiler):
+		if args.task == 'train':
+				train_model(int(args.num_epochs), args.train_filepath, args.model_filepath, args.cache_dir or None, args.hash_bits, args.processes, args.mix_every, args.seed, args.averaged, args.min_count, args.gold_only, args.prune, args.arc_pruning, args.batch_size or 1, args.decoder, args.dev_filepath, args.patience, args.resume, args.eval_sample)
+		elif args.task == 'update':
+				update_model(int(args.num_epochs), args.train_filepath, args.model_filepath, args.output_filepath, args.processes, args.mix_every, args.seed, args.averaged, args.min_count, args.gold_only, args.batch_size or 1, args.replay_filepath, args.replay_fraction, args.dev_filepath, args.patience, args.resume, args.eval_sample)
+		elif args.task == 'test':
+				test_model(args.model_filepath, args.test_filepath, args.processes, args.output_filepath, args.stream, args.arc_pruning, args.batch_size or 32, args.max_length, args.decoder, args.parse_cache, args.parse_cache_file)
+		elif args.task == 'eval':
+				evaluate_files(args.test_filepath, args.pred_filepath, args.processes)
+		elif args.task == 'convert':
+				convert_model(args.model_filepath, args.output_filepath)
+		elif args.task == 'serve':
+				serve_model(args.model_filepath, args.host, args.port, args.socket, args.batch_size or 64, args.max_wait_ms, args.max_length, args.decoder, args.parse_cache, args.parse_cache_file)
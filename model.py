@@ -1,10 +1,67 @@
+import os, copy, json, collections
 import numpy as np
 import timeit
 import random
 
 from IO import Reader, Writer, Data, Sentence, Token
 from feature import FeatureMapping
-from eisner import Eisner
+from decoders import make_decoder
+from parallel import pool_context, chunked, ordered_imap
+from instrument import metrics
+
+# Model and decoder used by prediction worker processes; set once per worker by set_worker_model
+worker_model = None
+worker_decoder = None
+
+def set_worker_model(model):
+	'''
+		Pool initializer. Under fork the model is inherited, not pickled, so every worker
+		reads the parent's weight vector and feature map pages instead of holding a copy.
+	'''
+	global worker_model, worker_decoder
+	worker_model = model
+	worker_model.parse_cache = None		# The parent looks sentences up and only sends the misses
+	worker_decoder = model.new_decoder()		# Kept for every chunk, so its workspace is reused
+
+def predict_chunk(sentences):
+	'''
+		Worker task: returns the predicted heads of a chunk of sentences, in order, and the worker's stage timings.
+	'''
+	return [sentence.predicted for sentence in worker_model.predict_batches(sentences, len(sentences), worker_decoder)], metrics.take()
+
+def evaluate_weights(weights):
+	'''
+		Worker task: UAS of worker_model on its own data (ie. a dev set) with the given weights.
+	'''
+	worker_model.weight_vector = weights
+	for sentence in worker_model.predict_batches(worker_model.data.sentences, 32, worker_decoder):
+		pass
+	return worker_model.data.evaluate(verbose=False)
+
+# Training worker state; set once per worker by set_worker_trainer
+worker_trainer = None
+
+def set_worker_trainer(model, shared, feature_index):
+	'''
+		Pool initializer for iterative parameter mixing; see Model.start_mixing_pool for the shared layout.
+	'''
+	global worker_trainer
+	weights = np.frombuffer(shared, dtype=np.float32).reshape(-1, len(model.weight_vector))
+	model.totals = None		# The parent averages the mixed weights
+	worker_trainer = (model, weights, feature_index, model.new_decoder())
+
+def train_shard(task):
+	'''
+		Worker task: starts from the mixed weights and trains on the sentence indices of one shard.
+		Leaves the result in the worker's row and returns the predicted heads for evaluation, and the worker's stage timings.
+	'''
+	w, indices = task
+	model, weights, feature_index, decoder = worker_trainer
+	model.weight_vector = weights[w + 1]
+	model.weight_vector[:] = weights[0]
+	for k in indices:
+		model.train_sentence(k, feature_index, decoder)
+	return indices, [model.data.sentences[k].predicted for k in indices], metrics.take()
 
 class Model:
 
@@ -13,84 +70,491 @@ class Model:
 			Uses every function and object imported above.
 	'''
 
-	def __init__(self, data, feature_mapping):		# Initialize with data (list of sentences) and a feature map
+	# Averaged perceptron accumulators; only set while training with averaged=True
+	totals = None		# Per-feature sum of weights over the sentences seen, up to timestamps
+	timestamps = None		# Sentence step at which each feature's total was last brought up to date
+	step = 0		# Sentences seen while averaging
+
+	model_id = None		# Set when loaded from a model file; identifies the exact weights
+	pruner = None		# Optional ArcPruner; arcs it prunes are never extracted and score -inf
+	max_length = 1024		# Longest sentence decoded; longer ones get a chain of heads (see Eisner)
+	decoder_name = "eisner"		# Key of decoders.DECODERS; saved with the model
+	parse_cache = None		# Optional ParseCache; cached sentences are not scored or decoded again
+	weight_buffer = None		# Storage with spare capacity behind weight_vector once it has grown; see grow_weights
+
+	def __init__(self, data, feature_mapping, weight_vector=None):		# Initialize with data (list of sentences) and a feature map
 		self.data = data
 		self.feature_mapping = feature_mapping
-		# Create weight_vector of 0's on instantiation
-		self.weight_vector = np.zeros(len(self.feature_mapping.map), dtype=np.float32)
+		if weight_vector is None:
+				# Create weight_vector of 0's on instantiation
+				# One extra weight at feature_mapping.unknown_id stays 0 for unknown features
+				weight_vector = np.zeros(self.feature_mapping.num_features + 1, dtype=np.float32)
+		self.weight_vector = weight_vector
 
-	def edge_scores(self, sentence):
+	def edge_scores(self, sentence, feature_ids=None, mask=None):
 			'''
 					Calculate edge_scores for a given sentence
+					feature_ids is the (n, n, T) array from FeatureMapping.feature_ids; built when not given
+					mask holds the candidate arcs of self.pruner (see arc_mask); pruned arcs score -inf,
+					so the decoder never picks them
 			'''
-			n = len(sentence.tokens)
-			arcs = sentence.potential_arcs()		# Get all arcs
-			scores = np.zeros([n, n], dtype=np.float32)		# Init scores to 0's
-			for arc in arcs:
-					# Get feature vector ids corresponding to current arc
-					feature_vectors = self.feature_mapping.extract_features(sentence, arc)
-					arc_score = 0		# Init arc's score to 0
-					for vector in feature_vectors:
-							arc_score += self.weight_vector[vector]		# Add corresponding weight to arc score
-					head, dep = int(arc[0]), int(arc[1])
-					scores[head][dep] = arc_score		# Store arc score in scores matrix
+			if feature_ids is None:
+					with metrics.timer("features", len(sentence) - 1):
+							if mask is None:
+									mask = self.arc_mask(sentence)
+							feature_ids = self.feature_mapping.feature_ids(sentence, mask)		# Only the candidate arcs are extracted
+			elif mask is None:
+					mask = self.arc_mask(sentence)
+			with metrics.timer("scoring", len(sentence) - 1):
+					scores = self.weight_vector[feature_ids].sum(-1)		# Gather and sum the weights of every arc at once
+					if mask is not None:
+							scores[~mask] = -np.inf
 			return scores
 
-	def train(self, epochs=5):
+	def new_decoder(self):
+			'''
+					A decoder of type decoder_name for this model; keep it for many sentences so its workspace is reused.
+			'''
+			return make_decoder(self.decoder_name, self.max_length)
+
+	def cache_version(self):
+			'''
+					Identifies everything a ParseCache entry depends on: the weights and features, the decoder and the pruning.
+			'''
+			pruning = "none" if self.pruner is None else str(self.pruner.k)
+			return " ".join([str(self.model_id), self.decoder_name, str(self.max_length), pruning])
+
+	def too_long(self, sentence, decoder):
+			'''
+					Gives a sentence the decoder would not decode (see is_too_long) its chain of heads right away,
+					before any features are extracted or scored, and returns True; False for every other sentence.
+			'''
+			if not decoder.is_too_long(len(sentence)):
+					return False
+			sentence.predicted[:] = np.arange(-1, len(sentence) - 1)		# Every token attached to the one before it
+			return True
+
+	def arc_mask(self, sentence):
+			'''
+					Candidate arcs of a sentence according to self.pruner; None without a pruner.
+			'''
+			if self.pruner is None:
+					return None
+			return self.pruner.mask(sentence)
+
+	def train(self, epochs=5, feature_index=None, processes=1, mix_every=None, seed=None, averaged=False, batch_size=1, dev_data=None, patience=None, checkpoint_filepath=None, resume=False, eval_sample=None):
 			'''
 					Trains the parser for given epochs.
 					Epochs defaulted to 5 when not given an argument.
+					feature_index is an optional FeatureIndex over self.data.sentences; features are extracted per sentence without it.
+					With processes > 1, trains by iterative parameter mixing: each epoch's shuffled sentences are split
+					into one shard per worker process, and the workers' weight vectors are averaged after every
+					mix_every sentences per shard (once per epoch when not given).
+					seed makes the shuffling, and so the whole run, reproducible.
+					With averaged, the final weights are the average of the weights after every sentence (averaged perceptron).
+					With batch_size > 1, that many sentences are decoded at once with the same weights before their updates
+					are applied (mini-batch perceptron); see train_batch. Only used on one process.
+					With dev_data, the weights after each epoch are evaluated on it in another process while the next epoch
+					trains. The final weights are those of the epoch with the best dev UAS, and training stops once
+					dev UAS has not improved for patience epochs (never when patience is None).
+					With checkpoint_filepath, a checkpoint is written after every epoch (see save_checkpoint);
+					with resume, training continues from it when the file exists.
+					eval_sample limits the training UAS reported after every epoch to that many random sentences.
+					Progress and per-epoch stage timings go to instrument.metrics.
 					No output; trains and updates the parser over epochs.
 			'''
-			decoder = Eisner()		# Create Eisner decoder
-			for i in np.arange(epochs):		# Iterate through epochs
-					random.shuffle(self.data.sentences)		# Shuffle data during each epoch
-					# Timer
-					starttime = timeit.default_timer()
-					print("Start time: " + str(starttime))
-					print("Epoch: " + str(i+1))
-					sentence_count = 1
-					for sentence in self.data.sentences:
-							arc_scores = self.edge_scores(sentence)		# Calculate edge_scores for current sentence
-							predicted = decoder.decode(arc_scores)		# Get best tree according to arc_scores
-							gold = sentence.gold_arcs()
-							# Compare predicted tree with gold tree looping over tokens
-							for token in sentence.tokens[1:]:
-									dep = token.id			# Current token is dep
-									predicted_head = predicted[dep]		# Get predicted head from arc dictionary
-									gold_head = gold[dep]		# Get actual (gold) head
-									predicted_arc = (predicted_head, dep)		# Create arcs for extracting features
-									gold_arc = (gold_head, dep)
-									token.x = predicted_head		# Store predicted head in Token
-
-									# Weights update (ie. training) time
-									if predicted_arc[0] != gold_arc[0]:		# If predicted arc/head is incorrect:
-											# Get feature vector_ids for both predicted and gold arcs
-											predicted_arc_vector_indices = self.feature_mapping.extract_features(sentence, predicted_arc)
-											gold_arc_vector_indices = self.feature_mapping.extract_features(sentence, gold_arc)
-											# Update weight vector by raising gold vector_id weights and lowering (incorrect) predicted vector_id weights
-											self.weight_vector[gold_arc_vector_indices] += 1
-											self.weight_vector[predicted_arc_vector_indices] -= 1
-							sentence_count += 1
-							if sentence_count % 100 == 0:
-									print("Time taken for past", sentence_count, "sentences:", (timeit.default_timer() - starttime))
-											
-					self.data.evaluate()		# Calculate current UAS
-					print("Time taken for epoch:", (timeit.default_timer() - starttime))
-					print("")
-
-	def make_predictions(self, data):
+			if dev_data is not None and not any(np.any(sentence.heads[1:] >= 0) for sentence in dev_data.sentences):
+					raise ValueError("The dev set has no token with a known gold head to compute UAS on")
+			decoder = self.new_decoder()		# Create decoder; its workspace is reused for every sentence
+			if averaged:
+					self.start_averaging()
+			rng = random.Random(seed)
+			sample_rng = random.Random(seed)		# Separate from rng, so sampling does not change the shuffling
+			order = list(range(len(self.data.sentences)))		# Sentence indices; shuffled so they still line up with feature_index
+			dev = {"best_uas": None, "best_epoch": None, "bad_epochs": 0}		# Early stopping state
+			best_weights = None		# Weights of dev["best_epoch"]
+			first_epoch = 0
+			if resume and checkpoint_filepath is not None and os.path.exists(checkpoint_filepath):
+					first_epoch, best_weights = self.load_checkpoint(checkpoint_filepath, rng, order, dev)
+					print("Resuming after epoch", first_epoch, "from", checkpoint_filepath)
+			pool, dev_pool, pending = None, None, None
+			if processes > 1:
+					pool, mixed_weights = self.start_mixing_pool(processes, feature_index)
+			if dev_data is not None:
+					dev_pool = self.start_dev_pool(dev_data)
+					if first_epoch > 0:		# The checkpointed epoch's dev evaluation was not finished
+							pending = self.evaluate_dev(dev_pool, first_epoch)
+			metrics.reset()
+			tokens = sum(len(sentence) - 1 for sentence in self.data.sentences)
+			try:
+					for i in range(first_epoch, epochs):		# Iterate through epochs
+							rng.shuffle(order)		# Shuffle data during each epoch
+							# Timer
+							starttime = timeit.default_timer()
+							print("Epoch: " + str(i+1))
+							if pool is None:
+									sentence_count = 0
+									for batch in chunked(order, batch_size):
+											self.train_batch(batch, feature_index, decoder)
+											sentence_count += len(batch)
+											if sentence_count % 100 < len(batch):
+													metrics.emit("progress", epoch=i+1, sentences=sentence_count, seconds=timeit.default_timer() - starttime)
+							else:
+									self.train_epoch_mixed(pool, mixed_weights, order, processes, mix_every, starttime, i+1)
+
+							uas = self.data.evaluate(sample=eval_sample, rng=sample_rng)		# Calculate current UAS
+							seconds = timeit.default_timer() - starttime
+							print("Time taken for epoch:", seconds)
+							metrics.emit("epoch", epoch=i+1, seconds=seconds, sentences=len(order), tokens=tokens, uas=uas, **metrics.take())
+
+							if pending is not None:		# Previous epoch's dev UAS, computed while this epoch trained
+									best_weights = self.finish_dev(pending, dev, best_weights)
+							if dev_pool is not None:
+									pending = self.evaluate_dev(dev_pool, i+1)
+							if checkpoint_filepath is not None:
+									self.save_checkpoint(checkpoint_filepath, i+1, rng, order, dev, best_weights)
+							print("")
+							if patience is not None and dev["bad_epochs"] >= patience:
+									print("Dev UAS has not improved for", patience, "epochs; stopping early")
+									break
+					if pending is not None:
+							best_weights = self.finish_dev(pending, dev, best_weights)
+			finally:
+					if pool is not None:
+							pool.close()
+							pool.join()
+							self.weight_vector = np.array(self.weight_vector)		# Copy out of shared memory
+					if dev_pool is not None:
+							dev_pool.terminate()
+							dev_pool.join()
+			if best_weights is not None:
+					print("Using the weights of epoch", dev["best_epoch"], "with dev UAS", dev["best_uas"])
+					self.weight_vector = best_weights
+					self.totals, self.timestamps, self.step = None, None, 0
+			elif averaged:
+					self.weight_vector = self.averaged_weights()
+					self.totals, self.timestamps, self.step = None, None, 0		# Not needed for parsing; keeps the saved model small
+
+	def evaluation_weights(self):
+			'''
+					A copy of the weights as they would be saved now; averaged while averaging.
+			'''
+			if self.totals is not None:
+					return self.averaged_weights()
+			return np.array(self.weight_vector)
+
+	def start_dev_pool(self, dev_data):
+			'''
+					One worker process holding a copy of this model with dev_data as its data; see evaluate_dev.
+			'''
+			dev_model = copy.copy(self)
+			dev_model.data = dev_data
+			dev_model.totals, dev_model.timestamps = None, None
+			return pool_context().Pool(1, initializer=set_worker_model, initargs=(dev_model,))
+
+	def evaluate_dev(self, dev_pool, epoch):
+			'''
+					Starts evaluating the current weights on the dev set; returns (epoch, weights, async result) for finish_dev.
+			'''
+			weights = self.evaluation_weights()
+			return epoch, weights, dev_pool.apply_async(evaluate_weights, (weights,))
+
+	def finish_dev(self, pending, dev, best_weights):
+			'''
+					Waits for a dev evaluation and updates the early stopping state dev; returns the best weights so far.
+			'''
+			epoch, weights, result = pending
+			uas = result.get()
+			print("Dev UAS after epoch " + str(epoch) + ":", uas)
+			metrics.emit("dev", epoch=epoch, uas=uas)
+			if dev["best_uas"] is None or uas > dev["best_uas"]:
+					dev.update(best_uas=uas, best_epoch=epoch, bad_epochs=0)
+					return weights
+			dev["bad_epochs"] += 1
+			return best_weights
+
+	def save_checkpoint(self, filepath, epoch, rng, order, dev, best_weights):
+			'''
+					Writes everything needed to resume training after epoch: the weights (and averaging totals),
+					the shuffling RNG state and sentence order, the early stopping state and the best weights so far.
+					Written to a temporary file first, so a crash while saving leaves the previous checkpoint intact.
+			'''
+			arrays = {"weights": np.asarray(self.weight_vector), "order": np.array(order, dtype=np.int64)}
+			if self.totals is not None:
+					arrays["totals"], arrays["timestamps"] = self.totals, self.timestamps
+			if best_weights is not None:
+					arrays["best_weights"] = best_weights
+			state = {"epoch": epoch, "rng": rng.getstate(), "dev": dev, "step": self.step, "num_weights": len(self.weight_vector)}
+			with open(filepath + ".tmp", 'wb') as f:
+					np.savez(f, state=np.array(json.dumps(state)), **arrays)
+			os.replace(filepath + ".tmp", filepath)
+
+	def load_checkpoint(self, filepath, rng, order, dev):
+			'''
+					Restores a checkpoint written by save_checkpoint into this model, rng, order and dev;
+					returns the epoch it was written after and the best weights (None without a dev set).
+			'''
+			with np.load(filepath) as checkpoint:
+					state = json.loads(str(checkpoint["state"]))
+					if state["num_weights"] != len(self.weight_vector) or len(checkpoint["order"]) != len(order):
+							raise ValueError(filepath + " was written for different training data or feature options")
+					self.weight_vector[:] = checkpoint["weights"]
+					if self.totals is not None:
+							if "totals" not in checkpoint:
+									raise ValueError(filepath + " was written without --averaged")
+							self.totals[:] = checkpoint["totals"]
+							self.timestamps[:] = checkpoint["timestamps"]
+							self.step = state["step"]
+					order[:] = checkpoint["order"].tolist()
+					best_weights = checkpoint["best_weights"] if "best_weights" in checkpoint else None
+			version, internal_state, gauss = state["rng"]
+			rng.setstate((version, tuple(internal_state), gauss))
+			dev.update(state["dev"])
+			return state["epoch"], best_weights
+
+	def train_sentence(self, k, feature_index, decoder):
+			'''
+					One perceptron step on sentence k of self.data: decode with the current weights,
+					store the prediction and update the weights for every incorrect head.
+			'''
+			self.train_batch([k], feature_index, decoder)
+
+	def train_batch(self, indices, feature_index, decoder):
+			'''
+					Perceptron steps on the sentences of self.data at indices. They are all decoded in one
+					decode_batch call with the current weights, then the weights are updated sentence by sentence.
+			'''
+			indices = [k for k in indices if not self.too_long(self.data.sentences[k], decoder)]		# Nothing to learn from a chain
+			if not indices:
+					return
+			sentences = [self.data.sentences[k] for k in indices]
+			features = [self.training_features(k, feature_index) for k in indices]
+			arc_scores = [self.edge_scores(sentence, feature_ids, mask) for sentence, (feature_ids, mask) in zip(sentences, features)]
+			with metrics.timer("decoding", max(len(sentence) for sentence in sentences) - 1):		# Bucketed by the longest sentence of the batch
+					trees = decoder.decode_batch(arc_scores)
+			for sentence, (feature_ids, mask), predicted in zip(sentences, features, trees):		# Get best trees according to arc_scores
+					sentence.predicted[:] = predicted		# Store predicted heads in the Sentence
+					self.learn(sentence, feature_ids, predicted)
+
+	def training_features(self, k, feature_index):
+			'''
+					Returns the (n, n, T) feature ids of sentence k of self.data and its arc_mask.
+			'''
+			sentence = self.data.sentences[k]
+			with metrics.timer("features", len(sentence) - 1):
+					mask = self.arc_mask(sentence)
+					if feature_index is not None:
+							feature_ids = feature_index[k]		# Precomputed features
+					elif mask is None:
+							feature_ids = self.feature_mapping.feature_ids(sentence)		# Extract features once per sentence
+					else:
+							feature_mask = mask.copy()		# Gold arcs are extracted even when pruned, so they can still be rewarded
+							gold_deps = np.nonzero(sentence.heads[1:] >= 0)[0] + 1
+							feature_mask[sentence.heads[gold_deps], gold_deps] = True
+							feature_ids = self.feature_mapping.feature_ids(sentence, feature_mask)
+			return feature_ids, mask
+
+	def learn(self, sentence, feature_ids, predicted):
+			'''
+					Perceptron update for one sentence given its predicted heads.
+			'''
+			with metrics.timer("update", len(sentence) - 1):
+					# Compare predicted tree with gold tree; ROOT is never a dependant
+					wrong = np.nonzero((predicted[1:] != sentence.heads[1:]) & (sentence.heads[1:] >= 0))[0] + 1		# Only incorrect predicted arcs/heads with a known gold head
+					# Weights update (ie. training) time
+					# Raise gold arc vector_id weights and lower (incorrect) predicted arc vector_id weights, summed per vector_id
+					# so repeated ids count every time and ids shared by both arcs cancel out
+					vector_ids = np.concatenate([feature_ids[sentence.heads[wrong], wrong].ravel(), feature_ids[predicted[wrong], wrong].ravel()])
+					signs = np.repeat(np.array([1, -1], dtype=np.float32), len(vector_ids) // 2)
+					vector_ids, inverse = np.unique(vector_ids, return_inverse=True)
+					deltas = np.bincount(inverse.ravel(), weights=signs, minlength=len(vector_ids))
+					keep = (deltas != 0) & (vector_ids != self.feature_mapping.unknown_id)
+					self.update(vector_ids[keep], deltas[keep])
+			if self.totals is not None:
+					self.step += 1
+
+	def update(self, vector_ids, deltas):
+			'''
+					Adds deltas to the weights of the (unique) vector_ids.
+					While averaging, first brings the totals of just those ids up to date (lazy averaging),
+					so an update costs O(number of updated features) rather than O(|w|).
+			'''
+			if self.totals is not None:
+					self.totals[vector_ids] += (self.step - self.timestamps[vector_ids]) * self.weight_vector[vector_ids]
+					self.timestamps[vector_ids] = self.step
+			self.weight_vector[vector_ids] += deltas
+
+	def extend_features(self, sentences, processes=1):
+			'''
+					Adds the features of sentences the model has not seen to its feature map and weight vector,
+					ie. before training a loaded model on new data; returns the number of features added.
+			'''
+			added = self.feature_mapping.extend(sentences, processes)
+			self.grow_weights()
+			return added
+
+	def grow_weights(self):
+			'''
+					Extends the weight vector to the size of the feature map; new features start at 0, as does the
+					weight at the moved unknown_id (the old unknown_id weight is always 0, so it is a valid new weight).
+					The weights are a view into weight_buffer, whose capacity at least doubles when it runs out,
+					so growing a few features at a time costs amortized O(1) per feature instead of a copy each time.
+			'''
+			size = self.feature_mapping.num_features + 1
+			buffer = self.weight_buffer
+			if buffer is None or self.weight_vector.base is not buffer or len(buffer) < size:
+					capacity = max(size, 2 * len(self.weight_vector))
+					buffer = np.zeros(capacity, dtype=np.float32)
+					buffer[:len(self.weight_vector)] = self.weight_vector		# Also copies a memory-mapped model out of its file
+					self.weight_buffer = buffer
+			self.weight_vector = buffer[:size]
+
+	def start_averaging(self):
+			self.totals = np.zeros(len(self.weight_vector), dtype=np.float64)
+			self.timestamps = np.zeros(len(self.weight_vector), dtype=np.int64)
+			self.step = 0
+
+	def averaged_weights(self):
+			'''
+					Average of the weight vector over every sentence seen since start_averaging.
+			'''
+			if self.step == 0:
+					return self.weight_vector.copy()
+			totals = self.totals + (self.step - self.timestamps) * self.weight_vector		# Bring every total up to date
+			return (totals / self.step).astype(np.float32)
+
+	def start_mixing_pool(self, processes, feature_index):
+			'''
+					Moves the weight vector into shared memory and starts the training workers.
+					Row 0 of the shared (processes + 1, |w|) array holds the mixed weights, row w + 1 worker w's weights,
+					so weights are never pickled between processes.
+			'''
+			context = pool_context()
+			size = len(self.weight_vector)
+			shared = context.RawArray('f', (processes + 1) * size)
+			mixed_weights = np.frombuffer(shared, dtype=np.float32).reshape(processes + 1, size)
+			mixed_weights[0] = self.weight_vector
+			self.weight_vector = mixed_weights[0]
+			pool = context.Pool(processes, initializer=set_worker_trainer, initargs=(self, shared, feature_index))
+			return pool, mixed_weights
+
+	def train_epoch_mixed(self, pool, mixed_weights, order, processes, mix_every, starttime, epoch):
+			'''
+					One epoch of iterative parameter mixing over the shuffled sentence indices in order.
+			'''
+			shards = [order[w::processes] for w in range(processes)]
+			longest = max(len(shard) for shard in shards)
+			if mix_every is None:
+					mix_every = longest		# Mix once per epoch
+			sentence_count = 0
+			for start in range(0, longest, mix_every):
+					tasks = [(w, shards[w][start:start+mix_every]) for w in range(processes) if shards[w][start:start+mix_every]]
+					results = pool.map(train_shard, tasks)		# Same task order every run, so mixing is deterministic
+					for indices, predicted, timings in results:
+							for k, heads in zip(indices, predicted):
+									self.data.sentences[k].predicted[:] = heads
+							metrics.merge(timings)		# Stage timings summed over the workers
+					workers = [w + 1 for w, indices in tasks]
+					mixed_weights[0] = mixed_weights[workers].mean(axis=0)		# Uniform mixing of the shards that trained
+					round_count = sum(len(indices) for w, indices in tasks)
+					if self.totals is not None:		# Averaging over mixed weights, weighted by the sentences of the round
+							self.totals += round_count * mixed_weights[0]
+							self.step += round_count
+							self.timestamps[:] = self.step
+					sentence_count += round_count
+					metrics.emit("progress", epoch=int(epoch), sentences=sentence_count, seconds=timeit.default_timer() - starttime)
+
+	def prune(self):
+			'''
+					Drops zero-weight features after training; see FeatureMapping.prune.
+			'''
+			self.weight_vector = self.feature_mapping.prune(self.weight_vector)
+
+	def make_predictions(self, data, batch_size=32):
 			'''
 					Function that makes predictions with the current parser on given data.
 					Used during validation and testing.
 					Similar process to training, except no feature_map population nor updating weights.
-					Populates one of the empty columns with the predicted_head.
-			'''
-			decoder = Eisner()
-			for sentence in data.sentences:
-					arc_scores = self.edge_scores(sentence)		# Calculate arc scores
-					predicted = decoder.decode(arc_scores)		# Predict best tree
-					for token in sentence.tokens[1:]:
-							dep = token.id
-							predicted_head = predicted[dep]		# Get predicted head from dictionary.
-							sentence.tokens[int(dep)].x = predicted_head		# Populate Token.x with predicted head
+					Populates sentence.predicted with the predicted heads, decoding batch_size sentences at once.
+			'''
+			for sentence in self.predict_batches(data.sentences, batch_size):
+					pass
+
+	def predict(self, sentences, processes=1, batch_size=32):
+			'''
+					predict_batches on one process or predict_parallel on several.
+			'''
+			if processes > 1:
+					return self.predict_parallel(sentences, processes, batch_size)
+			return self.predict_batches(sentences, batch_size)
+
+	def predict_stream(self, sentences):
+			'''
+					Generator version of make_predictions for any iterable of sentences.
+					Each sentence is parsed when it arrives and yielded with sentence.predicted filled in,
+					so only one sentence at a time needs to be in memory.
+			'''
+			decoder = self.new_decoder()
+			for sentence in sentences:
+					misses = self.cache_lookup([sentence])		# Nothing to parse when cached
+					if misses and not self.too_long(sentence, decoder):
+							arc_scores = self.edge_scores(sentence)		# Calculate arc scores
+							with metrics.timer("decoding", len(sentence) - 1):
+									sentence.predicted[:] = decoder.decode(arc_scores)		# Predict best tree
+							self.cache_store(misses[0][1], sentence.predicted)
+					yield sentence
+
+	def predict_batches(self, sentences, batch_size=32, decoder=None):
+			'''
+					predict_stream that reads batch_size sentences at a time and decodes them together
+					with the decoder's decode_batch; sentences are yielded in input order.
+			'''
+			if decoder is None:
+					decoder = self.new_decoder()
+			for batch in chunked(sentences, batch_size):
+					misses = self.cache_lookup(batch)		# Only sentences not in the cache are parsed
+					misses = [(sentence, key) for sentence, key in misses if not self.too_long(sentence, decoder)]
+					if misses:
+							arc_scores = [self.edge_scores(sentence) for sentence, key in misses]		# Calculate arc scores
+							with metrics.timer("decoding", max(len(sentence) for sentence, key in misses) - 1):		# Bucketed by the longest sentence of the batch
+									trees = decoder.decode_batch(arc_scores)
+							for (sentence, key), predicted in zip(misses, trees):		# Predict best trees
+									sentence.predicted[:] = predicted
+									self.cache_store(key, predicted)
+					yield from batch
+
+	def predict_parallel(self, sentences, processes, chunk_size=32):
+			'''
+					Parallel version of predict_batches over a pool of worker processes.
+					Sentences are sent to the workers in chunks, each decoded as one batch, and yielded in input order.
+					At most 2 * processes chunks are in flight, so a streamed input is never read ahead further than that.
+					With a parse_cache, chunks are looked up here and only their misses are sent to the workers.
+			'''
+			chunks = collections.deque()		# (chunk, misses) of the chunks in flight, in input order
+
+			def chunk_misses():
+					for chunk in chunked(sentences, chunk_size):
+							misses = self.cache_lookup(chunk)
+							chunks.append((chunk, misses))
+							yield [sentence for sentence, key in misses]
+
+			with pool_context().Pool(processes, initializer=set_worker_model, initargs=(self,)) as pool:
+					for sent, (predicted_heads, timings) in ordered_imap(pool, predict_chunk, chunk_misses(), 2 * processes):
+							metrics.merge(timings)		# Stage timings summed over the workers
+							chunk, misses = chunks.popleft()
+							for (sentence, key), predicted in zip(misses, predicted_heads):
+									sentence.predicted[:] = predicted
+									self.cache_store(key, predicted)
+							yield from chunk
+
+	def cache_lookup(self, sentences):
+			'''
+					ParseCache.lookup with self.parse_cache; every sentence is a miss (with key None) without one.
+			'''
+			if self.parse_cache is None:
+					return [(sentence, None) for sentence in sentences]
+			return self.parse_cache.lookup(sentences)
+
+	def cache_store(self, key, predicted):
+			if self.parse_cache is not None:
+					self.parse_cache.store(key, predicted)
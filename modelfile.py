@@ -0,0 +1,126 @@
+import json, hashlib, zlib
+import numpy as np
+
+from feature import FeatureMapping, FEATURE_TEMPLATES
+from model import Model
+from pruner import ArcPruner
+
+'''
+	Script with classes for reading and writing trained models.
+
+	File layout:
+		MAGIC | uint32 version | uint32 header length | JSON header | padding
+		weights as raw little-endian float32 | padding
+		feature map keys as zlib-compressed UTF-8, one per line, in vector_id order
+	Padding aligns both sections to ALIGNMENT bytes, so the weights can be memory-mapped
+	straight from the file and their pages shared by every process that loads the model.
+'''
+
+MAGIC = b'DEPMODEL'
+VERSION = 1
+ALIGNMENT = 64
+
+def aligned(offset):
+	return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def is_model_file(filepath):
+	'''
+		True for files in this format; False for older gzip-pickled models.
+	'''
+	with open(filepath, 'rb') as f:
+		return f.read(len(MAGIC)) == MAGIC
+
+def model_contents(model):
+	'''
+		Returns the weights as little-endian float32, the feature map keys in vector_id order, the keys as UTF-8 lines,
+		and the model_id: the SHA-1 of the weights and keys, which identifies these exact weights and features, ie. for caches.
+	'''
+	feature_mapping = model.feature_mapping
+	weights = np.ascontiguousarray(model.weight_vector, dtype='<f4')
+	keys = sorted(feature_mapping.map, key=feature_mapping.map.get)		# Keys in vector_id order
+	key_bytes = "\n".join(keys).encode('utf-8')
+	model_id = hashlib.sha1()
+	model_id.update(weights.tobytes())
+	model_id.update(key_bytes)
+	return weights, keys, key_bytes, model_id.hexdigest()
+
+class ModelWriter:
+
+	'''
+		Use the ModelWriter object to save a Model's weights and feature map; the training data is not saved.
+	'''
+
+	def __init__(self, filepath, model):
+		self.filepath = filepath
+		self.model = model
+
+	def write_file(self):
+		feature_mapping = self.model.feature_mapping
+		weights, keys, key_bytes, model_id = model_contents(self.model)
+		key_bytes = zlib.compress(key_bytes)		# Keys share long template prefixes and compress well
+
+		header = json.dumps({
+			"templates": FEATURE_TEMPLATES,
+			"hash_bits": feature_mapping.hash_bits,
+			"num_weights": len(weights),
+			"num_keys": len(keys),
+			"key_bytes": len(key_bytes),
+			"model_id": model_id,
+			"decoder": self.model.decoder_name,
+			"pruner": self.model.pruner.to_dict() if self.model.pruner is not None else None,
+		}).encode('utf-8')
+		preamble = MAGIC + np.array([VERSION, len(header)], dtype='<u4').tobytes() + header
+		weights_offset = aligned(len(preamble))
+		keys_offset = aligned(weights_offset + weights.nbytes)
+
+		with open(self.filepath, 'wb') as f:
+			f.write(preamble)
+			f.write(b'\0' * (weights_offset - len(preamble)))
+			f.write(weights.tobytes())
+			f.write(b'\0' * (keys_offset - weights_offset - weights.nbytes))
+			f.write(key_bytes)
+
+class ModelReader:
+
+	'''
+		Use the ModelReader object to load a Model written by ModelWriter.
+		The weight vector is a read-only memory map of the file.
+	'''
+
+	def __init__(self, filepath):
+		self.filepath = filepath
+
+	def read_header(self, f):
+		'''
+			Returns the header dictionary and the offset right after the header.
+		'''
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError(self.filepath + " is not a model file")
+		version, header_length = np.frombuffer(f.read(8), dtype='<u4')
+		if version != VERSION:
+			raise ValueError("Unsupported model file version " + str(version) + " in " + self.filepath)
+		header = json.loads(f.read(int(header_length)).decode('utf-8'))
+		if header["templates"] != FEATURE_TEMPLATES:
+			raise ValueError(self.filepath + " was trained with different feature templates")
+		return header, len(MAGIC) + 8 + int(header_length)
+
+	def read_file(self):
+		with open(self.filepath, 'rb') as f:
+			header, header_end = self.read_header(f)
+			weights_offset = aligned(header_end)
+			keys_offset = aligned(weights_offset + 4 * header["num_weights"])
+			f.seek(keys_offset)
+			keys = zlib.decompress(f.read(header["key_bytes"])).decode('utf-8').split("\n") if header["num_keys"] else []
+
+		feature_mapping = FeatureMapping([], header["hash_bits"])
+		feature_mapping.map = dict(zip(keys, range(len(keys))))
+		feature_mapping.vector_id = len(keys)
+		feature_mapping.frozen = True
+
+		weight_vector = np.memmap(self.filepath, dtype='<f4', mode='r', offset=weights_offset, shape=(header["num_weights"],))
+		model = Model(None, feature_mapping, weight_vector)
+		model.model_id = header["model_id"]
+		model.decoder_name = header.get("decoder", "eisner")		# Files written before decoders were selectable
+		if header.get("pruner") is not None:
+			model.pruner = ArcPruner.from_dict(header["pruner"])
+		return model
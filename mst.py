@@ -0,0 +1,115 @@
+import numpy as np
+
+'''
+		Maximum spanning tree decoding with the Chu-Liu-Edmonds algorithm; unlike Eisner, trees may be non-projective.
+'''
+
+class ChuLiuEdmonds:
+
+	'''
+			Class object for the decoder using the Chu-Liu-Edmonds algorithm.
+			Every round picks the best head of every token and, if those arcs form a cycle,
+			contracts it into one node; each round costs O(n²) NumPy work. A sentence needs one round
+			per nested cycle, so decoding is O(n²) when the greedy heads are (nearly) a tree, as they are
+			for a trained model, and O(n³) in the worst case; Tarjan's O(n²) variant needs mergeable
+			heaps that are slower than this in Python at sentence lengths.
+			Uses the same max_length and too_long policy as Eisner.
+	'''
+
+	def __init__(self, max_length=1024, too_long='chain'):
+		if too_long not in ('chain', 'error'):
+			raise ValueError("too_long must be 'chain' or 'error'")
+		self.max_length = max_length
+		self.too_long = too_long
+		self.long_sentences = 0		# Sentences handled by the too_long policy
+
+	def is_too_long(self, n):
+		'''
+				True if a sentence of n tokens (ROOT included) is longer than max_length and gets a chain of heads;
+				raises a ValueError instead with too_long='error'. Callers can check this before scoring a sentence.
+		'''
+		if self.max_length is None or n <= self.max_length:
+			return False
+		if self.too_long == 'error':
+			raise ValueError("Sentence of " + str(n) + " tokens is longer than max_length " + str(self.max_length))
+		self.long_sentences += 1
+		return True
+
+	def decode(self, edge_scores):
+		'''
+				Calculates the best tree given an edge_scores matrix indexed by [head, dependant].
+				Returns an int array of heads indexed by dependant; the ROOT entry is -1.
+		'''
+		n = edge_scores.shape[0]
+		if self.is_too_long(n):
+			return np.arange(-1, n-1)		# Every token attached to the one before it
+
+		scores = np.array(edge_scores, dtype=np.float64)
+		scores[:, 0] = -np.inf		# ROOT is never a dependant
+		np.fill_diagonal(scores, -np.inf)
+		contractions = []		# Stack of the cycles contracted so far, innermost last
+
+		while True:
+			heads = np.argmax(scores, axis=0)		# Best head of every node
+			heads[0] = -1
+			cycle = self.find_cycle(heads)
+			if cycle is None:
+				break
+			# Contract the cycle into a new last node; ROOT is never in a cycle, so it stays node 0
+			outside = np.setdiff1d(np.arange(len(heads)), cycle)
+			cycle_scores = scores[heads[cycle], cycle]
+			# Entering the cycle at d breaks the cycle arc into d: gain scores[h, d] - cycle_scores[d]
+			enter = scores[outside[:, None], cycle] - cycle_scores
+			enter_best = np.argmax(enter, axis=1)		# Best cycle node to enter from each outside node
+			leave = scores[cycle[:, None], outside]
+			leave_best = np.argmax(leave, axis=0)		# Best cycle node to leave from towards each outside node
+
+			m = len(outside)
+			contracted = np.full([m + 1, m + 1], -np.inf)
+			contracted[:m, :m] = scores[outside[:, None], outside]
+			contracted[:m, m] = enter[np.arange(m), enter_best]
+			contracted[m, :m] = leave[leave_best, np.arange(m)]
+			contractions.append((outside, cycle, heads[cycle], enter_best, leave_best))
+			scores = contracted
+
+		# Expand the contracted cycles again, innermost first
+		while contractions:
+			outside, cycle, cycle_heads, enter_best, leave_best = contractions.pop()
+			m = len(outside)
+			expanded = -np.ones(m + len(cycle), dtype=int)
+			for i in range(1, m):
+				if heads[i] == m:		# Head is the contracted cycle
+					expanded[outside[i]] = cycle[leave_best[i]]
+				else:
+					expanded[outside[i]] = outside[heads[i]]
+			expanded[cycle] = cycle_heads		# Keep the cycle arcs except the one broken by the entering arc
+			entering = heads[m]		# Outside node the cycle hangs from
+			expanded[cycle[enter_best[entering]]] = outside[entering]
+			heads = expanded
+		return heads
+
+	def decode_batch(self, edge_scores_list):
+		'''
+				decode for every edge_scores matrix in a list; same interface as Eisner.decode_batch.
+		'''
+		return [self.decode(edge_scores) for edge_scores in edge_scores_list]
+
+	@staticmethod
+	def find_cycle(heads):
+		'''
+				Returns the nodes of one cycle of a head array as an int array, or None if it is a tree.
+		'''
+		n = len(heads)
+		state = np.zeros(n, dtype=np.int8)		# 0 unvisited, 1 on the current path, 2 done
+		state[0] = 2
+		for start in range(1, n):
+			path = []
+			node = start
+			while state[node] == 0:
+				state[node] = 1
+				path.append(node)
+				node = heads[node]
+			if state[node] == 1:		# Walked back into the current path
+				return np.array(path[path.index(node):])
+			state[path] = 2
+		return None
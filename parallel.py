@@ -0,0 +1,40 @@
+import collections, itertools, multiprocessing
+
+'''
+	Helpers shared by the multi-process parts of the parser.
+'''
+
+def pool_context():
+	'''
+		Prefer fork so workers share the parent's memory (model, corpus) instead of pickling it;
+		fall back to the platform default.
+	'''
+	if 'fork' in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('fork')
+	return multiprocessing.get_context()
+
+def chunked(iterable, size):
+	'''
+		Yields lists of up to size items; works on generators without materializing them.
+	'''
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if not chunk:
+			return
+		yield chunk
+
+def ordered_imap(pool, function, chunks, window):
+	'''
+		Like pool.imap, but with at most window chunks in flight, so a streamed input is only read
+		that far ahead (pool.imap reads all of its input up front). Yields (chunk, result) in input order.
+	'''
+	pending = collections.deque()
+	for chunk in chunks:
+		pending.append((chunk, pool.apply_async(function, (chunk,))))
+		if len(pending) >= window:
+			done, result = pending.popleft()
+			yield done, result.get()
+	while pending:
+		done, result = pending.popleft()
+		yield done, result.get()
@@ -0,0 +1,89 @@
+import os, hashlib, collections
+import numpy as np
+
+from IO import FORM, POS
+
+'''
+	Script with the ParseCache, which remembers the predicted heads of sentences already parsed,
+	so repeated sentences (boilerplate, headers, re-submitted documents) skip scoring and decoding.
+'''
+
+class ParseCache:
+
+	'''
+		LRU cache of predicted heads, keyed by a hash of a sentence's form and POS strings (the only columns
+		features are extracted from) and of version, which identifies the model and decoding settings
+		(see Model.cache_version). Holds at most max_size sentences; the least recently used are dropped first.
+		With a filepath, entries are loaded from there when written for the same version, and save writes them back.
+		.hits and .misses count lookups since the cache was created.
+	'''
+
+	def __init__(self, version, max_size=100000, filepath=None):
+		if max_size < 1:
+			raise ValueError("max_size must be at least 1")
+		self.version = version
+		self.max_size = max_size
+		self.filepath = filepath
+		self.entries = collections.OrderedDict()		# key -> int32 heads; least recently used first
+		self.hits, self.misses = 0, 0
+		if filepath is not None and os.path.exists(filepath):
+			self.load(filepath)
+
+	def key(self, sentence):
+		digest = hashlib.blake2b(self.version.encode("utf-8"), digest_size=16)
+		digest.update("\t".join(sentence.strings(FORM)).encode("utf-8"))
+		digest.update(b"\n")
+		digest.update("\t".join(sentence.strings(POS)).encode("utf-8"))
+		return digest.digest()
+
+	def lookup(self, sentences):
+		'''
+			Fills in sentence.predicted of every cached sentence.
+			Returns the others as (sentence, key) pairs, to be parsed and passed to store.
+		'''
+		misses = []
+		for sentence in sentences:
+			key = self.key(sentence)
+			heads = self.entries.get(key)
+			if heads is None or len(heads) != len(sentence):		# Length check guards against hash collisions
+				misses.append((sentence, key))
+				continue
+			self.entries.move_to_end(key)
+			sentence.predicted[:] = heads
+		self.hits += len(sentences) - len(misses)
+		self.misses += len(misses)
+		return misses
+
+	def store(self, key, heads):
+		self.entries[key] = np.array(heads, dtype=np.int32)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "hit_rate": self.hits / lookups if lookups else None}
+
+	def load(self, filepath):
+		'''
+			Adds the entries of a file written by save; ignored when written for another version.
+		'''
+		with np.load(filepath) as saved:
+			if str(saved["version"]) != self.version:
+				return
+			keys, offsets, heads = saved["keys"], saved["offsets"], saved["heads"]
+		for i in range(max(len(keys) - self.max_size, 0), len(keys)):		# Oldest first, so the LRU order is kept
+			self.entries[keys[i].tobytes()] = heads[offsets[i]:offsets[i+1]]
+
+	def save(self, filepath=None):
+		'''
+			Writes the entries to filepath (self.filepath when not given), through a temporary file.
+		'''
+		filepath = filepath or self.filepath
+		entries = list(self.entries.items())
+		keys = np.frombuffer(b"".join(key for key, heads in entries), dtype=np.uint8).reshape(len(entries), 16)
+		offsets = np.cumsum([0] + [len(heads) for key, heads in entries])
+		heads = np.concatenate([heads for key, heads in entries]) if entries else np.zeros(0, dtype=np.int32)
+		with open(filepath + ".tmp", 'wb') as f:
+			np.savez(f, version=np.array(self.version), keys=keys, offsets=offsets, heads=heads)
+		os.replace(filepath + ".tmp", filepath)
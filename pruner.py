@@ -0,0 +1,123 @@
+import numpy as np
+
+from IO import POS
+
+'''
+	Script with the ArcPruner, a cheap first pass that limits the candidate heads of each dependant
+	before features are extracted and scored.
+'''
+
+class ArcPruner:
+
+	'''
+		Arc filter learned from the gold trees of the training data.
+		.tags -> dictionary of POS tag to table index; index 0 is shared by tags unseen in training
+		.max_distance -> (tags, tags, 2) int array; longest gold arc per (head POS, dependant POS, direction L=0/R=1)
+		.counts -> (tags, tags, 2*max_bucket+1) int array; gold arcs per POS pair and signed distance bucket
+		An arc is a candidate if it is no longer than max_distance for its POS pair and direction (pairs unseen
+		in training are not limited), and is one of the k best heads of its dependant under
+		log P(distance bucket | POS pair) + log P(distance bucket).
+		ROOT arcs and arcs between neighbouring tokens are always kept, so a projective tree always exists.
+	'''
+
+	max_bucket = 10		# Signed distances further than this share the outermost bucket
+
+	def __init__(self, k, tags, max_distance, counts):
+		if k < 1:
+			raise ValueError("k must be at least 1")
+		self.k = k
+		self.tags = tags
+		self.max_distance = max_distance
+		self.counts = counts
+		self.set_scores()
+
+	@classmethod
+	def train(cls, sentences, k):
+		'''
+			Learns the tables from the gold heads of sentences; unknown heads ('_') are skipped.
+		'''
+		tags = {}
+		head_tags, dep_tags, distances = [], [], []
+		for sentence in sentences:
+			pos = np.array([tags.setdefault(tag, len(tags) + 1) for tag in sentence.strings(POS)])
+			deps = np.nonzero(sentence.heads[1:] >= 0)[0] + 1		# ROOT is never a dependant
+			heads = sentence.heads[deps]
+			head_tags.append(pos[heads])
+			dep_tags.append(pos[deps])
+			distances.append(deps - heads)
+		head_tags, dep_tags, distances = (np.concatenate(values).astype(int) if values else np.zeros(0, dtype=int) for values in (head_tags, dep_tags, distances))
+
+		size = len(tags) + 1
+		max_distance = np.zeros([size, size, 2], dtype=np.int32)
+		np.maximum.at(max_distance, (head_tags, dep_tags, (distances > 0).astype(int)), np.abs(distances))
+		counts = np.zeros([size, size, 2 * cls.max_bucket + 1], dtype=np.int64)
+		np.add.at(counts, (head_tags, dep_tags, np.clip(distances, -cls.max_bucket, cls.max_bucket) + cls.max_bucket), 1)
+		return cls(k, tags, max_distance, counts)
+
+	def set_scores(self):
+		'''
+			Add-one smoothed log probabilities from self.counts.
+		'''
+		pair_counts = self.counts.sum(-1, keepdims=True)
+		bucket_counts = self.counts.sum((0, 1))
+		buckets = self.counts.shape[-1]
+		self.scores = np.log((self.counts + 1) / (pair_counts + buckets)) + np.log((bucket_counts + 1) / (bucket_counts.sum() + buckets))
+		self.seen = pair_counts[..., 0] > 0		# POS pairs with at least one gold arc
+
+	def mask(self, sentence):
+		'''
+			Returns an (n, n) boolean array indexed by [head, dependant]; True for the candidate arcs.
+		'''
+		n = len(sentence)
+		pos = np.array([self.tags.get(tag, 0) for tag in sentence.strings(POS)])
+		distance = np.arange(n)[None, :] - np.arange(n)[:, None]		# dependant - head; positive for right arcs
+		head_pos, dep_pos = pos[:, None], pos[None, :]
+		allowed = ~self.seen[head_pos, dep_pos] | (np.abs(distance) <= self.max_distance[head_pos, dep_pos, (distance > 0).astype(int)])
+		scores = np.where(allowed, self.scores[head_pos, dep_pos, np.clip(distance, -self.max_bucket, self.max_bucket) + self.max_bucket], -np.inf)
+		np.fill_diagonal(scores, -np.inf)
+
+		if self.k < n - 1:		# Otherwise every allowed head is among the k best
+			best = np.argpartition(-scores, self.k - 1, axis=0)[:self.k]		# k best heads of each dependant
+			keep = np.zeros([n, n], dtype=bool)
+			keep[best, np.arange(n)] = True
+			keep &= np.isfinite(scores)
+		else:
+			keep = np.isfinite(scores)
+		keep[0] = True		# ROOT arcs
+		deps = np.arange(1, n)
+		keep[deps - 1, deps] = True		# Left neighbour as head
+		keep[deps[:-1] + 1, deps[:-1]] = True		# Right neighbour as head
+		keep[:, 0] = False		# ROOT is never a dependant
+		return keep
+
+	def oracle_recall(self, sentences):
+		'''
+			Returns (share of gold arcs kept, share of potential arcs kept) over sentences with gold heads,
+			ie. the best UAS a parser could reach after pruning and how much work pruning leaves.
+		'''
+		gold, kept, candidates, potential = 0, 0, 0, 0
+		for sentence in sentences:
+			n = len(sentence)
+			keep = self.mask(sentence)
+			deps = np.nonzero(sentence.heads[1:] >= 0)[0] + 1
+			gold += len(deps)
+			kept += int(keep[sentence.heads[deps], deps].sum())
+			candidates += int(keep.sum())
+			potential += (n - 1) ** 2
+		return kept / max(gold, 1), candidates / max(potential, 1)
+
+	def to_dict(self):
+		'''
+			JSON-friendly form, ie. for a model file header.
+		'''
+		return {
+			"k": self.k,
+			"tags": sorted(self.tags, key=self.tags.get),		# Tags in table index order
+			"max_distance": self.max_distance.tolist(),
+			"counts": self.counts.tolist(),
+		}
+
+	@classmethod
+	def from_dict(cls, values):
+		tags = {tag: index + 1 for index, tag in enumerate(values["tags"])}
+		return cls(values["k"], tags, np.array(values["max_distance"], dtype=np.int32), np.array(values["counts"], dtype=np.int64))
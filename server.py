@@ -0,0 +1,264 @@
+import io, os, json, time, queue, signal, threading, collections, socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+from IO import Writer, parse_block, vocabulary
+from instrument import metrics
+
+'''
+	Script with a long-running parse server: the model is loaded once, and CoNLL-06 sentences are parsed over
+	local HTTP, on a TCP port or a Unix socket.
+
+	POST /parse -> body of one or more CoNLL-06 sentences; returns them with predicted heads,
+	               or {"heads": [[...], ...], "milliseconds": ...} with ?format=json
+	GET /health -> {"status": "ok", ...} once the model is loaded
+	GET /metrics -> request counts, latency percentiles, batch sizes, parse cache hits and stage timings
+
+	Requests that arrive together are parsed as one batch (micro-batching) by a single parsing thread,
+	which also keeps the process-wide Vocabulary single-threaded; the strings of each batch are dropped from it
+	once the batch is answered, so memory does not grow with the distinct input the server sees.
+'''
+
+class ParseRequest:
+
+	'''
+		One request waiting for the Batcher; done is set once body or error is filled in.
+	'''
+
+	def __init__(self, text, output_format):
+		self.text = text
+		self.output_format = output_format
+		self.sentences = []
+		self.body = None
+		self.error = None
+		self.done = threading.Event()
+
+class Batcher(threading.Thread):
+
+	'''
+		Parsing thread. Takes the first waiting request, then keeps collecting requests for up to max_wait
+		seconds or until max_batch sentences are waiting, and parses all their sentences with one
+		Model.predict_batches call, so concurrent requests share the decoding work.
+		A request not answered within timeout seconds gets a 503.
+	'''
+
+	def __init__(self, model, max_batch=64, max_wait=0.002, timeout=30.0):
+		super().__init__(daemon=True)
+		self.model = model
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.timeout = timeout
+		self.vocabulary_size = len(vocabulary)		# Strings of the model's process; everything after is per batch
+		self.requests = queue.Queue()
+		self.decoder = model.new_decoder()		# One decoder, so its workspace is reused for every batch
+		self.batch_sizes = collections.deque(maxlen=1000)		# Sentences per batch, most recent batches
+
+	def parse(self, text, output_format='conll'):
+		'''
+			Called from request threads; blocks until the request is parsed.
+		'''
+		request = ParseRequest(text, output_format)
+		self.requests.put(request)
+		if not request.done.wait(self.timeout):
+			request.error = (503, "No parse within " + str(self.timeout) + " seconds")
+		return request
+
+	def run(self):
+		while True:
+			batch = [self.requests.get()]
+			try:
+				self.read_sentences(batch[0])
+				sentence_count = len(batch[0].sentences)
+				deadline = time.perf_counter() + self.max_wait
+				while sentence_count < self.max_batch:
+					try:
+						request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+					except queue.Empty:
+						break
+					batch.append(request)
+					self.read_sentences(request)
+					sentence_count += len(request.sentences)
+				self.parse_batch(batch)
+			except Exception as error:		# Fail this batch's requests instead of the parsing thread
+				for request in batch:
+					if request.error is None and request.body is None:
+						request.error = (500, repr(error))
+			finally:
+				vocabulary.truncate(self.vocabulary_size)		# The batch's sentences are done with
+				for request in batch:
+					request.done.set()
+
+	def read_sentences(self, request):
+		try:
+			request.sentences = parse_block(request.text)
+		except Exception as error:		# ie. ValueError for a malformed line, OverflowError for an id beyond int32
+			request.sentences = []
+			request.error = (400, str(error))
+
+	def parse_batch(self, batch):
+		'''
+			Parses the sentences of every valid request of batch and fills in their bodies.
+		'''
+		sentences = [sentence for request in batch if request.error is None for sentence in request.sentences]
+		try:
+			for sentence in self.model.predict_batches(sentences, max(len(sentences), 1), self.decoder):
+				pass
+		except Exception as error:
+			for request in batch:
+				if request.error is None:
+					request.error = (500, repr(error))
+		self.batch_sizes.append(len(sentences))
+		for request in batch:
+			if request.error is None:
+				try:
+					request.body = self.response_body(request)
+				except Exception as error:
+					request.error = (500, repr(error))
+
+	@staticmethod
+	def response_body(request):
+		if request.output_format == 'json':
+			return json.dumps({"heads": [sentence.predicted[1:].tolist() for sentence in request.sentences]})
+		output = io.StringIO()
+		for sentence in request.sentences:
+			sentence.use_predictions()
+			Writer.write_sentence(output, sentence)
+		return output.getvalue()
+
+class ServerStats:
+
+	'''
+		Request counters and the latencies of the most recent requests, in milliseconds.
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.requests, self.errors, self.sentences, self.tokens = 0, 0, 0, 0
+		self.latencies = collections.deque(maxlen=1000)
+
+	def record(self, request, milliseconds):
+		with self.lock:
+			self.requests += 1
+			if request.error is not None:
+				self.errors += 1
+				return
+			self.sentences += len(request.sentences)
+			self.tokens += sum(len(sentence) - 1 for sentence in request.sentences)
+			self.latencies.append(milliseconds)
+
+	def report(self, batcher):
+		with self.lock:
+			latencies = np.array(self.latencies)
+			batch_sizes = np.array(batcher.batch_sizes)
+			report = {
+				"uptime_seconds": time.time() - self.started,
+				"requests": self.requests,
+				"errors": self.errors,
+				"sentences": self.sentences,
+				"tokens": self.tokens,
+				"queued": batcher.requests.qsize(),
+				"latency_ms": {
+					"mean": float(latencies.mean()) if len(latencies) else None,
+					"p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+					"p90": float(np.percentile(latencies, 90)) if len(latencies) else None,
+					"p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+					"max": float(latencies.max()) if len(latencies) else None,
+				},
+				"mean_batch_sentences": float(batch_sizes.mean()) if len(batch_sizes) else None,
+			}
+		if batcher.model.parse_cache is not None:
+			report["parse_cache"] = batcher.model.parse_cache.stats()
+		report.update(metrics.snapshot())		# Stage timings since the server started
+		return report
+
+class ParseHandler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"		# Keep-alive, so clients can reuse one connection for many requests
+
+	def do_GET(self):
+		path = urlparse(self.path).path
+		if path == "/health":
+			model = self.server.batcher.model
+			self.send(200, json.dumps({"status": "ok", "model_id": model.model_id, "decoder": model.decoder_name, "features": model.feature_mapping.num_features}), "application/json")
+		elif path == "/metrics":
+			self.send(200, json.dumps(self.server.stats.report(self.server.batcher)), "application/json")
+		else:
+			self.send(404, json.dumps({"error": "not found"}), "application/json")
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		if url.path != "/parse":
+			self.send(404, json.dumps({"error": "not found"}), "application/json")
+			return
+		starttime = time.perf_counter()
+		length = int(self.headers.get("Content-Length", 0))
+		text = self.rfile.read(length).decode("utf-8")
+		output_format = parse_qs(url.query).get("format", ["conll"])[0]
+		request = self.server.batcher.parse(text, output_format)
+		milliseconds = (time.perf_counter() - starttime) * 1000
+		self.server.stats.record(request, milliseconds)
+		if request.error is not None:
+			status, message = request.error
+			self.send(status, json.dumps({"error": message}), "application/json")
+		elif output_format == 'json':
+			self.send(200, request.body[:-1] + ', "milliseconds": ' + json.dumps(milliseconds) + '}', "application/json")
+		else:
+			self.send(200, request.body, "text/plain; charset=utf-8", {"X-Parse-Milliseconds": "%.3f" % milliseconds})
+
+	def send(self, status, body, content_type, headers={}):
+		body = body.encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		return self.client_address[0] if self.client_address else "unix"		# Unix socket clients have no address
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+class ParseHTTPServer(ThreadingHTTPServer):
+	request_queue_size = 128		# socketserver's default backlog of 5 resets concurrent clients' connections
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+	request_queue_size = 128
+
+def stop_serving(signum, frame):
+	raise KeyboardInterrupt		# SIGTERM shuts down like Ctrl-C, removing the Unix socket
+
+def serve(model, host='127.0.0.1', port=8080, socket_path=None, max_batch=64, max_wait=0.002, verbose=False, timeout=30.0):
+	'''
+		Serves model until interrupted or terminated; on socket_path (a Unix socket) when given, otherwise on host:port.
+		Requests waiting longer than timeout seconds for the parser get a 503.
+	'''
+	batcher = Batcher(model, max_batch, max_wait, timeout)
+	batcher.start()
+	if socket_path is not None:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)		# Left over from a previous run
+		server = ThreadingUnixHTTPServer(socket_path, ParseHandler)
+		address = socket_path
+	else:
+		server = ParseHTTPServer((host, port), ParseHandler)
+		address = "http://" + host + ":" + str(server.server_address[1])
+	server.batcher = batcher
+	server.stats = ServerStats()
+	server.verbose = verbose
+	print("Serving on", address, flush=True)
+	signal.signal(signal.SIGTERM, stop_serving)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if socket_path is not None and os.path.exists(socket_path):
+			os.remove(socket_path)
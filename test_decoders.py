@@ -0,0 +1,118 @@
+import itertools, unittest
+import numpy as np
+
+from eisner import Eisner
+from mst import ChuLiuEdmonds
+
+'''
+	Checks of the decoders against brute force over every (projective) tree of short sentences, and of batched
+	against single-sentence decoding. Run with python -m unittest test_decoders (or pytest).
+'''
+
+def is_tree(heads):
+	'''
+		True if every token reaches ROOT (token 0) through its heads.
+	'''
+	for dep in range(1, len(heads)):
+		seen = set()
+		node = dep
+		while node != 0:
+			if node in seen or heads[node] < 0:
+				return False
+			seen.add(node)
+			node = heads[node]
+	return True
+
+def is_projective(heads):
+	'''
+		True if no two arcs cross.
+	'''
+	arcs = [(min(head, dep), max(head, dep)) for dep, head in enumerate(heads) if dep != 0]
+	return not any(a < c < b < d for (a, b), (c, d) in itertools.permutations(arcs, 2))
+
+def tree_score(edge_scores, heads):
+	return float(sum(edge_scores[heads[dep], dep] for dep in range(1, len(heads))))
+
+def best_score(edge_scores, projective):
+	'''
+		Score of the best tree over every head assignment; projective trees only with projective.
+	'''
+	n = edge_scores.shape[0]
+	best = -np.inf
+	for assignment in itertools.product(range(n), repeat=n-1):
+		heads = [-1] + list(assignment)
+		if any(heads[dep] == dep for dep in range(1, n)) or not is_tree(heads):
+			continue
+		if projective and not is_projective(heads):
+			continue
+		best = max(best, tree_score(edge_scores, heads))
+	return best
+
+def random_scores(rng, n):
+	return rng.normal(size=(n, n)).astype(np.float32)
+
+class TestEisner(unittest.TestCase):
+
+	def test_best_projective_tree(self):
+		rng = np.random.default_rng(0)
+		decoder = Eisner()
+		for n in [2, 3, 4, 5, 6] * 20:
+			edge_scores = random_scores(rng, n)
+			heads = decoder.decode(edge_scores)
+			self.assertEqual(heads[0], -1)
+			self.assertTrue(is_tree(heads) and is_projective(heads))
+			self.assertAlmostEqual(tree_score(edge_scores, heads), best_score(edge_scores, True), places=4)
+
+	def test_batch_matches_single(self):
+		rng = np.random.default_rng(1)
+		matrices = [random_scores(rng, n) for n in rng.integers(2, 40, 200)]
+		single = [Eisner().decode(edge_scores) for edge_scores in matrices]
+		decoder = Eisner()		# One decoder, so its workspace is reused across batches of different shapes
+		for batch_size in [1, 7, 64]:
+			batched = [tree for start in range(0, len(matrices), batch_size) for tree in decoder.decode_batch(matrices[start:start+batch_size])]
+			for expected, heads in zip(single, batched):
+				np.testing.assert_array_equal(expected, heads)
+
+	def test_split_batches(self):
+		rng = np.random.default_rng(2)
+		matrices = [random_scores(rng, 30) for _ in range(20)]
+		decoder = Eisner()
+		decoder.max_cells = 2 * 32 * 32		# Two sentences per decode_padded call
+		for edge_scores, heads in zip(matrices, decoder.decode_batch(matrices)):
+			np.testing.assert_array_equal(Eisner().decode(edge_scores), heads)
+
+	def test_too_long(self):
+		edge_scores = random_scores(np.random.default_rng(3), 12)
+		np.testing.assert_array_equal(Eisner(max_length=10).decode(edge_scores), np.arange(-1, 11))
+		with self.assertRaises(ValueError):
+			Eisner(max_length=10, too_long='error').decode(edge_scores)
+
+class TestChuLiuEdmonds(unittest.TestCase):
+
+	def test_best_tree(self):
+		rng = np.random.default_rng(4)
+		decoder = ChuLiuEdmonds()
+		for n in [2, 3, 4, 5, 6] * 40:
+			edge_scores = random_scores(rng, n)
+			heads = decoder.decode(edge_scores)
+			self.assertEqual(heads[0], -1)
+			self.assertTrue(is_tree(heads))
+			self.assertAlmostEqual(tree_score(edge_scores, heads), best_score(edge_scores, False), places=4)
+
+	def test_never_worse_than_eisner(self):
+		rng = np.random.default_rng(5)
+		for n in rng.integers(2, 30, 100):
+			edge_scores = random_scores(rng, n)
+			heads = ChuLiuEdmonds().decode(edge_scores)
+			self.assertTrue(is_tree(heads))
+			self.assertGreaterEqual(tree_score(edge_scores, heads) + 1e-4, tree_score(edge_scores, Eisner().decode(edge_scores)))
+
+	def test_batch_matches_single(self):
+		rng = np.random.default_rng(6)
+		matrices = [random_scores(rng, n) for n in rng.integers(2, 30, 50)]
+		decoder = ChuLiuEdmonds()
+		for edge_scores, heads in zip(matrices, decoder.decode_batch(matrices)):
+			np.testing.assert_array_equal(decoder.decode(edge_scores), heads)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,92 @@
+import os, random, tempfile, unittest
+import numpy as np
+
+from IO import Data, parse_block
+from feature import FeatureMapping
+from model import Model
+from modelfile import ModelReader, ModelWriter, model_contents
+
+'''
+	Checks of training against plain references: lazy averaging against the dense average of the weights after
+	every sentence, resuming from a checkpoint against an uninterrupted run, and the model file round trip.
+	Run with python -m unittest test_model (or pytest).
+'''
+
+FORMS = ["w" + str(i) for i in range(30)]
+TAGS = ["DT", "NN", "VB", "JJ", "IN", "PRP"]
+
+def random_block(rng, count):
+	'''
+		CoNLL-06 text of count random sentences; every head is an earlier token, so the gold heads form a tree.
+	'''
+	sentences = []
+	for _ in range(count):
+		lines = []
+		for dep in range(1, rng.randint(2, 10) + 1):
+			form, tag = rng.choice(FORMS), rng.choice(TAGS)
+			lines.append("\t".join([str(dep), form, form, tag, tag, "_", str(rng.randrange(dep)), "dep", "_", "_"]))
+		sentences.append("\n".join(lines))
+	return "\n\n".join(sentences) + "\n\n"
+
+def new_model(seed=0, count=40):
+	'''
+		An untrained Model on count random sentences, with the feature map of their arcs.
+	'''
+	sentences = parse_block(random_block(random.Random(seed), count))
+	feature_map = FeatureMapping(sentences)
+	feature_map.create_map()
+	feature_map.frozen = True
+	return Model(Data(sentences), feature_map)
+
+class TestAveraging(unittest.TestCase):
+
+	def test_lazy_matches_dense(self):
+		model = new_model(1)
+		decoder = model.new_decoder()
+		model.start_averaging()
+		dense = np.zeros(len(model.weight_vector), dtype=np.float64)		# Sum of the weights after every sentence
+		steps = 0
+		for epoch in range(3):
+			for k in range(len(model.data.sentences)):
+				model.train_sentence(k, None, decoder)
+				dense += model.weight_vector
+				steps += 1
+		self.assertEqual(model.step, steps)
+		self.assertTrue(np.any(model.weight_vector != 0))
+		np.testing.assert_allclose(model.averaged_weights(), dense / steps, rtol=1e-5, atol=1e-6)
+
+class TestTraining(unittest.TestCase):
+
+	def test_resume_matches_uninterrupted(self):
+		for averaged in [False, True]:
+			with tempfile.TemporaryDirectory() as directory:
+				checkpoint = os.path.join(directory, "model.checkpoint")
+				expected = new_model(2)
+				expected.train(3, seed=5, averaged=averaged)
+				interrupted = new_model(2)
+				interrupted.train(1, seed=5, averaged=averaged, checkpoint_filepath=checkpoint)
+				resumed = new_model(2)
+				resumed.train(3, seed=5, averaged=averaged, checkpoint_filepath=checkpoint, resume=True)
+				np.testing.assert_array_equal(expected.weight_vector, resumed.weight_vector)
+
+	def test_model_file_round_trip(self):
+		model = new_model(3)
+		model.train(2, seed=6)
+		model.decoder_name = "mst"
+		with tempfile.TemporaryDirectory() as directory:
+			filepath = os.path.join(directory, "model")
+			ModelWriter(filepath, model).write_file()
+			loaded = ModelReader(filepath).read_file()
+			np.testing.assert_array_equal(model.weight_vector, loaded.weight_vector)
+			self.assertEqual(model.feature_mapping.map, loaded.feature_mapping.map)
+			self.assertEqual(loaded.model_id, model_contents(model)[3])
+			self.assertEqual(loaded.decoder_name, "mst")
+			sentences = model.data.sentences
+			expected = [sentence.predicted.copy() for sentence in model.predict_batches(sentences, 8)]
+			predicted = [sentence.predicted.copy() for sentence in loaded.predict_batches(sentences, 8)]
+			del loaded		# Releases the memory map before the directory is removed
+		for expected_heads, heads in zip(expected, predicted):
+			np.testing.assert_array_equal(expected_heads, heads)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,60 +1,259 @@
-import pickle, gzip
+import os, sys, pickle, gzip, timeit, random
+import numpy as np
 
 from IO import Reader, Writer, Data, Sentence, Token
-from feature import FeatureMapping
-from eisner import Eisner
+from feature import FeatureMapping, FeatureIndex
 from model import Model
+from pruner import ArcPruner
+from parsecache import ParseCache
+from evaluation import Evaluation
+from instrument import metrics
+from server import serve
+from modelfile import ModelReader, ModelWriter, is_model_file, model_contents
 
 '''
 		Utils script for running train/test functions.
 		Arguments configured via argparse.
 '''
 
-def train_model(num_epochs, train_filepath, model_filepath):
+def train_model(num_epochs, train_filepath, model_filepath, cache_dir=None, hash_bits=None, processes=1, mix_every=None, seed=None, averaged=False, min_count=1, gold_only=False, prune=False, arc_pruning=None, batch_size=1, decoder=None, dev_filepath=None, patience=3, resume=False, eval_sample=None):
 
 		'''
 				Training process:
-					1. Read in training_data with a Reader.
-					2. Create corresponding feature_map dictionary.
-							a. Once done populating, set feature_map.frozen to True.
+					1. Read in training_data with a Reader; train_filepath may be a list of files or a glob.
+					2. Create corresponding feature_map dictionary and the FeatureIndex of the training data.
+							a. With a cache_dir, both are loaded from there when the same file was seen before.
+							b. With hash_bits, the feature space is hashed and there is no map to populate.
+							   Otherwise min_count and gold_only restrict which features are mapped.
+							c. Once done populating, set feature_map.frozen to True.
 					3. Create the dependency parser Model with training_data and feature_map.
-					4. Call train() and run the training process.
-					5. Once training is over, save the model via cPickle and gzip.
+							a. With arc_pruning, learn an ArcPruner keeping that many candidate heads per dependant,
+							   and report its oracle recall on the training data.
+							b. With decoder, it decodes with that decoder (see decoders.DECODERS) instead of Eisner; saved with the model.
+					4. Call train() and run the training process; across processes by parameter mixing with processes > 1.
+							a. With averaged, the saved weights are the averaged perceptron weights.
+							b. With batch_size > 1, that many sentences are decoded at once between updates (mini-batch perceptron).
+							c. After every epoch, a checkpoint is written next to the model (model_filepath + ".checkpoint");
+							   with resume, training continues from it. It is deleted once the model is saved.
+							d. With dev_filepath, the dev set is parsed after every epoch while the next one trains; training
+							   stops once dev UAS has not improved for patience epochs, and the best epoch's weights are saved.
+							e. With eval_sample, the training UAS after each epoch is computed on that many random sentences.
+					5. Once training is over, drop zero-weight features if prune is set, and save the model with a ModelWriter.
 		'''
-		reader = Reader(train_filepath)
+		reader = Reader(train_filepath, processes)
 		training_data = Data(reader.read_file())
 
-		feature_map = FeatureMapping(training_data.sentences)
-		feature_map.create_map()
+		feature_map = FeatureMapping(training_data.sentences, hash_bits, min_count, gold_only)
+		cache_path = None
+		if cache_dir is not None:
+				cache_path = os.path.join(cache_dir, FeatureIndex.cache_key(train_filepath, feature_map))
+		if cache_path is not None and os.path.isdir(cache_path):
+				feature_index = FeatureIndex.load(cache_path, feature_map)
+		else:
+				feature_map.create_map(processes=processes)
+				feature_index = FeatureIndex.build(feature_map, training_data.sentences)
+				if cache_path is not None:
+						feature_index.save(cache_path, feature_map)
 		feature_map.frozen=True
 
 		dep_parser = Model(training_data, feature_map)
-		dep_parser.train(num_epochs)
+		if decoder is not None:
+				dep_parser.decoder_name = decoder
+		if arc_pruning is not None:
+				dep_parser.pruner = ArcPruner.train(training_data.sentences, arc_pruning)
+				report_pruning(dep_parser.pruner, training_data.sentences)
+		dev_data = None
+		if dev_filepath is not None:
+				dev_data = Data(Reader(dev_filepath, processes).read_file())
+		checkpoint_filepath = model_filepath + ".checkpoint"
+		dep_parser.train(num_epochs, feature_index, processes, mix_every, seed, averaged, batch_size, dev_data, patience, checkpoint_filepath, resume, eval_sample)
 
-		stream = gzip.open(model_filepath, 'wb')
-		pickle.dump(dep_parser,stream,-1)
+		if prune:
+				dep_parser.prune()
+		ModelWriter(model_filepath, dep_parser).write_file()
+		if os.path.exists(checkpoint_filepath):
+				os.remove(checkpoint_filepath)		# The model is saved; there is nothing left to resume
+
+def update_model(num_epochs, train_filepath, model_filepath, output_filepath=None, processes=1, mix_every=None, seed=None, averaged=False, min_count=1, gold_only=False, batch_size=1, replay_filepath=None, replay_fraction=0.1, dev_filepath=None, patience=3, resume=False, eval_sample=None):
+
+		'''
+				Incremental training process:
+					1. Load a trained model with load_model and read the new training data with a Reader.
+							a. With replay_filepath (ie. the original training data), a replay_fraction sample of its
+							   sentences is mixed in, so the model does not drift too far towards the new data.
+					2. Extend the model's feature map with the features of the new data not mapped yet (min_count and
+					   gold_only as in train_model), growing the weight vector; existing ids and weights are kept.
+					3. Train on the new data only, starting from the loaded weights, with the options of train_model.
+					4. Save the model to output_filepath; model_filepath is overwritten when not given.
+				The pruner and decoder of the loaded model are kept.
+		'''
+		dep_parser = load_model(model_filepath)
+		sentences = Reader(train_filepath, processes).read_file()
+		if replay_filepath is not None:
+				replay = Reader(replay_filepath, processes).read_file()
+				sentences += random.Random(seed).sample(replay, int(round(replay_fraction * len(replay))))
+		training_data = Data(sentences)
+
+		feature_map = dep_parser.feature_mapping
+		feature_map.min_count, feature_map.gold_only = min_count, gold_only
+		added = dep_parser.extend_features(training_data.sentences, processes)
+		print("Added", added, "features for", len(training_data.sentences), "sentences; now", feature_map.num_features)
+		feature_index = FeatureIndex.build(feature_map, training_data.sentences)
+
+		dep_parser.data = training_data
+		dep_parser.model_id = None		# The weights are about to change
+		dev_data = None
+		if dev_filepath is not None:
+				dev_data = Data(Reader(dev_filepath, processes).read_file())
+		output_filepath = output_filepath or model_filepath
+		checkpoint_filepath = output_filepath + ".checkpoint"
+		dep_parser.train(num_epochs, feature_index, processes, mix_every, seed, averaged, batch_size, dev_data, patience, checkpoint_filepath, resume, eval_sample)
+		ModelWriter(output_filepath, dep_parser).write_file()
+		if os.path.exists(checkpoint_filepath):
+				os.remove(checkpoint_filepath)		# The model is saved; there is nothing left to resume
+
+def evaluate_files(gold_filepath, predicted_filepath, processes=1):
+
+		'''
+				Scores the heads (and labels) of a .pred file against a gold file with the same sentences;
+				prints UAS, LAS and their breakdowns by sentence length, distance and POS, and emits them as an eval event.
+		'''
+		gold = Reader(gold_filepath, processes).read_file()
+		predicted = Reader(predicted_filepath, processes).read_file()
+		evaluation = Evaluation(gold, predicted)
+		print(evaluation.format())
+		metrics.emit("eval", gold=gold_filepath, predicted=predicted_filepath, **evaluation.report())
+		return evaluation
+
+def load_model(model_filepath):
+
+		'''
+				Loads a trained dependency parser model with a ModelReader.
+				Models saved via cPickle and gzip by older versions still load; convert_model rewrites them.
+		'''
+		if is_model_file(model_filepath):
+				return ModelReader(model_filepath).read_file()
+		stream = gzip.open(model_filepath, 'rb')
+		dep_parser = pickle.load(stream)
 		stream.close()
+		if len(dep_parser.weight_vector) == dep_parser.feature_mapping.num_features:		# Pickled before the unknown_id weight existed
+				dep_parser.weight_vector = np.append(dep_parser.weight_vector, np.float32(0))
+		dep_parser.model_id = model_contents(dep_parser)[3]		# The id the model gets once converted
+		return dep_parser
 
-def test_model(model_filepath, test_filepath):
+def convert_model(model_filepath, output_filepath):
+
+		'''
+				Rewrites a gzip-pickled model in the model file format, dropping its training data.
+		'''
+		dep_parser = load_model(model_filepath)
+		ModelWriter(output_filepath, dep_parser).write_file()
+
+def predicted_sentences(sentences, starttime):
+
+		'''
+				Puts each sentence's predictions in its heads column before it is written.
+				Once all are written, emits a predict event with the stage timings since starttime.
+		'''
+		sentence_count, tokens = 0, 0
+		for sentence in sentences:
+				sentence.use_predictions()
+				sentence_count += 1
+				tokens += len(sentence) - 1
+				yield sentence
+		metrics.emit("predict", seconds=timeit.default_timer() - starttime, sentences=sentence_count, tokens=tokens, **metrics.take())
+
+def test_model(model_filepath, test_filepath, processes=1, output_filepath=None, stream=False, arc_pruning=None, batch_size=32, max_length=None, decoder=None, parse_cache_size=None, parse_cache_filepath=None):
 
 		'''
 				Testing process:
 					1. Read in testing data with a Reader.
-					2. Load in trained dependency parser model via cPickle and gzip.
-					3. Call Model.make_predictions on the testing data's sentences.
-					4. Populate the Token.heads with predictions.
+					2. Load in trained dependency parser model with load_model.
+					3. Call Model.predict on the testing data's sentences, decoding batch_size sentences at once; in parallel with processes > 1.
+					4. Populate the heads column with predictions.
 					5. Write out the list of sentences with a Writer.
+				output_filepath defaults to <test basename>.pred in the current directory; '-' writes to stdout.
+				With stream, sentences are read, parsed and written one at a time (test_filepath '-' reads stdin),
+				so memory stays flat and each parse is flushed as soon as it is done; with processes > 1,
+				they are parsed in chunks of batch_size, so output follows a chunk at a time.
+				arc_pruning overrides the number of candidate heads kept by the model's ArcPruner, ie. to tune it;
+				without stream, the pruner's oracle recall on the testing data is reported on stderr.
+				max_length overrides Model.max_length, the longest sentence that is decoded,
+				and decoder the decoder the model was trained with, ie. to compare decoders under the same scores.
+				With parse_cache_size, repeated sentences are parsed once (see use_parse_cache).
 		'''
-		reader = Reader(test_filepath)
-		testing_data = Data(reader.read_file())
+		starttime = timeit.default_timer()
+		metrics.reset()
+		reader = Reader(test_filepath, processes)
+		dep_parser = load_model(model_filepath)
+		if max_length is not None:
+				dep_parser.max_length = max_length
+		if decoder is not None:
+				dep_parser.decoder_name = decoder
+		if arc_pruning is not None:
+				if dep_parser.pruner is None:
+						raise ValueError(model_filepath + " was trained without arc pruning")
+				dep_parser.pruner.k = arc_pruning
+		use_parse_cache(dep_parser, parse_cache_size, parse_cache_filepath)
 
-		stream = gzip.open(model_filepath, 'rb')
-		dep_parser = pickle.load(stream)
-		stream.close()
-		dep_parser.make_predictions(testing_data)
-		for sentence in testing_data.sentences:
-				for token in sentence.tokens:
-						token.head = token.x
-						token.x = "_"
-		writer = Writer(test_filepath, testing_data.sentences)
-		writer.write_file()
+		if stream and processes == 1:
+				sentences = dep_parser.predict_stream(reader.sentences())		# One at a time, so each parse is written as soon as its sentence is read
+		elif stream:
+				sentences = dep_parser.predict(reader.sentences(), processes, batch_size)
+		else:
+				testing_data = Data(reader.read_file())
+				if dep_parser.pruner is not None:
+						report_pruning(dep_parser.pruner, testing_data.sentences, sys.stderr)
+				sentences = list(dep_parser.predict(testing_data.sentences, processes, batch_size))
+		writer = Writer(test_filepath, predicted_sentences(sentences, starttime))
+		writer.write_file(output_filepath, flush=stream)
+		close_parse_cache(dep_parser)
+
+def report_pruning(pruner, sentences, file=None):
+
+		'''
+				Prints the oracle recall of an ArcPruner on sentences, ie. to tune its k.
+		'''
+		recall, kept = pruner.oracle_recall(sentences)
+		print("Arc pruning with k =", pruner.k, "keeps", kept, "of potential arcs; oracle recall:", recall, file=file)
+
+def use_parse_cache(dep_parser, size, filepath=None):
+
+		'''
+				Gives dep_parser a ParseCache of size sentences, loaded from filepath when it was written for the same model
+				and settings; no cache when size is None or 0. Call once the model's decoding settings are final.
+		'''
+		if size and filepath is not None and dep_parser.model_id is None:
+				raise ValueError("A model without a model_id (not loaded from a file) cannot use a persistent parse cache")
+		if size:
+				dep_parser.parse_cache = ParseCache(dep_parser.cache_version(), size, filepath)
+
+def close_parse_cache(dep_parser):
+
+		'''
+				Reports the hits and misses of dep_parser's ParseCache on stderr and saves it when it has a filepath.
+		'''
+		cache = dep_parser.parse_cache
+		if cache is None:
+				return
+		stats = cache.stats()
+		print("Parse cache:", stats["hits"], "hits,", stats["misses"], "misses,", stats["entries"], "entries", file=sys.stderr)
+		metrics.emit("parse_cache", **stats)
+		if cache.filepath is not None:
+				cache.save()
+
+def serve_model(model_filepath, host='127.0.0.1', port=8080, socket_path=None, batch_size=64, max_wait_ms=2.0, max_length=None, decoder=None, parse_cache_size=None, parse_cache_filepath=None):
+
+		'''
+				Loads a model once and serves it with server.serve until interrupted.
+				Up to batch_size sentences of requests arriving within max_wait_ms of each other are decoded together.
+				With parse_cache_size, repeated sentences are answered from a ParseCache, saved on shutdown with a parse_cache_filepath.
+		'''
+		dep_parser = load_model(model_filepath)
+		if max_length is not None:
+				dep_parser.max_length = max_length
+		if decoder is not None:
+				dep_parser.decoder_name = decoder
+		use_parse_cache(dep_parser, parse_cache_size, parse_cache_filepath)
+		serve(dep_parser, host, port, socket_path, batch_size, max_wait_ms / 1000)
+		close_parse_cache(dep_parser)